@@ -0,0 +1,133 @@
+# (C) 2014 by Dominik Jain (djain@gmx.net)
+
+import hashlib
+import threading
+import collections
+import weakref
+import logging
+
+log = logging.getLogger(__name__)
+
+def blobKey(data):
+    ''' returns the content hash under which the given data is stored '''
+    return hashlib.sha1(data).hexdigest()
+
+class BlobStore(object):
+    ''' a content-addressed store of binary data (e.g. encoded images), which objects reference by key (the data's hash);
+        blobs that are not available locally can be requested, such that they are fetched only once (via onMissing).
+        Objects hold references to the blobs they use (see acquire); once the data held in memory exceeds maxBytes,
+        the least recently used blobs that are either no longer referenced or can be read from their source are dropped '''
+
+    def __init__(self, maxBytes=256 * 1024 * 1024):
+        self.blobs = collections.OrderedDict() # key -> data, least recently used first
+        self.numBytes = 0 # total size of the data in blobs
+        self.maxBytes = maxBytes
+        self.refs = {} # key -> number of references held (see acquire)
+        self.sources = {} # key -> function returning the data (for blobs that are kept on disk rather than in memory)
+        self.decoded = weakref.WeakValueDictionary() # key -> decoded representation currently in use (e.g. a surface)
+        self.waiters = {} # key -> list of callbacks waiting for the blob
+        self.lock = threading.RLock()
+        self.onMissing = None # function which is called with the key of a blob that is requested but not available
+
+    def put(self, data):
+        ''' adds the given data, returning its key; callbacks waiting for it are called '''
+        key = blobKey(data)
+        with self.lock:
+            if key not in self.blobs:
+                self.blobs[key] = data
+                self.numBytes += len(data)
+            waiters = self.waiters.pop(key, [])
+        for callback in waiters:
+            callback(key)
+        return key
+
+    def addSource(self, key, read):
+        ''' makes the blob with the given key available via the given function, which is called whenever the data is needed
+            but not held in memory (such that the data held in memory may be dropped) '''
+        with self.lock:
+            self.sources[key] = read
+            waiters = self.waiters.pop(key, [])
+            self._evict()
+        for callback in waiters:
+            callback(key)
+
+    def get(self, key):
+        ''' returns the data of the blob with the given key or None if it is not available '''
+        with self.lock:
+            data = self.blobs.pop(key, None)
+            if data is not None:
+                self.blobs[key] = data # most recently used
+                return data
+            read = self.sources.get(key)
+        if read is None:
+            return None
+        return read()
+
+    def acquire(self, *keys):
+        ''' adds a reference to each of the blobs with the given keys (which need not be available yet); a referenced blob
+            is kept in memory unless it can be read from its source '''
+        with self.lock:
+            for key in keys:
+                self.refs[key] = self.refs.get(key, 0) + 1
+
+    def release(self, *keys):
+        ''' removes a reference added by acquire from each of the blobs with the given keys '''
+        with self.lock:
+            for key in keys:
+                n = self.refs.pop(key, 0) - 1
+                if n > 0:
+                    self.refs[key] = n
+            self._evict()
+
+    def _evict(self):
+        ''' drops the least recently used blobs that can be dropped until the data held in memory no longer exceeds maxBytes '''
+        if self.numBytes <= self.maxBytes:
+            return
+        for key in [key for key in self.blobs if key in self.sources or key not in self.refs]:
+            self.numBytes -= len(self.blobs.pop(key))
+            if self.numBytes <= self.maxBytes:
+                break
+
+    def __contains__(self, key):
+        return key in self.blobs or key in self.sources
+
+    def getDecoded(self, key, decode):
+        ''' returns the decoded representation of the blob with the given key, which is shared among all users as long as
+            it is referenced; decode is applied to the data if there is no such representation '''
+        with self.lock:
+            value = self.decoded.get(key)
+            if value is None:
+                value = decode(self.get(key))
+                self.decoded[key] = value
+            return value
+
+    def setDecoded(self, key, value):
+        ''' registers an existing decoded representation for the blob with the given key, returning the representation
+            to use (an equivalent one that is already in use, if any) '''
+        with self.lock:
+            existing = self.decoded.get(key)
+            if existing is not None:
+                return existing
+            self.decoded[key] = value
+            return value
+
+    def request(self, key, callback):
+        ''' calls callback(key) once the blob with the given key is available (immediately, if it already is);
+            if it is not, onMissing is called, unless the blob has already been requested '''
+        with self.lock:
+            available = key in self
+            if not available:
+                waiters = self.waiters.get(key)
+                isFirstRequest = waiters is None
+                if isFirstRequest:
+                    waiters = self.waiters[key] = []
+                waiters.append(callback)
+        if available:
+            callback(key)
+        elif isFirstRequest and self.onMissing is not None:
+            self.onMissing(key)
+
+    def missingKeys(self):
+        ''' returns the keys of the blobs that have been requested but are not available yet '''
+        with self.lock:
+            return self.waiters.keys()
@@ -0,0 +1,604 @@
+# (C) 2014 by Dominik Jain (djain@gmx.net)
+
+import os
+import shutil
+import struct
+import zlib
+import pickle
+import threading
+import time
+import mmap
+import logging
+import pygame
+import spatial
+
+log = logging.getLogger(__name__)
+
+# A document file (.wyb) is a header followed by a sequence of records. Each record is framed by a header
+# (record type, object id, payload length, CRC-32 of the payload), so a truncated or corrupted tail can be detected
+# and everything before it recovered. Saves only append: a PUT record for every new or changed object, a DELETE record
+# for every removed object, an INDEX record listing the offsets and absolute extents of all current PUT records and
+# finally an END record pointing to that index. Once the garbage left behind by earlier saves outweighs the live records,
+# the file is rewritten (compacted). As the index holds the extents of all objects, a document can be opened lazily
+# (see LazyLoader), reading only the records of the objects near the viewport.
+# The blobs objects reference (see blobstore) are stored once each, in BLOB records (payload: blob key followed by
+# the data), which are listed by a BLOB_INDEX record the END record also points to. As the index entry of an object
+# lists the keys of the blobs it references, blobs that are no longer referenced are dropped.
+# Since version 4, all objects are schema-encoded (see objects.encodeObject); the pickled objects of earlier versions
+# are read only when importing such a document, which is rewritten in full when it is next saved.
+
+MAGIC = "WYPB"
+VERSION = 4
+HEADER = struct.Struct("!4sB")
+RECORD = struct.Struct("!BdII")
+INDEX_ENTRIES = {
+    1: struct.Struct("!dQI"), # object id, record offset, record size
+    2: struct.Struct("!dQIiiii"), # object id, record offset, record size, absolute extents (x, y, width, height)
+    3: struct.Struct("!dQIiiiiH"), # as in version 2 plus the number of referenced blobs, whose keys follow the entry
+}
+INDEX_ENTRIES[4] = INDEX_ENTRIES[3]
+INDEX_ENTRY = INDEX_ENTRIES[VERSION]
+BLOB_KEY = struct.Struct("!40s")
+BLOB_ENTRY = struct.Struct("!40sQI") # blob key, record offset, record size
+END_PAYLOADS = {
+    1: struct.Struct("!Q"), # offset of the index record
+    2: struct.Struct("!Q"),
+    3: struct.Struct("!QQ"), # offsets of the index record and the blob index record
+}
+END_PAYLOADS[4] = END_PAYLOADS[3]
+END_PAYLOAD = END_PAYLOADS[VERSION]
+
+PUT, DELETE, INDEX, END, BLOB, BLOB_INDEX = range(1, 7)
+
+END_SIZE = RECORD.size + END_PAYLOAD.size
+
+class FormatError(Exception):
+    pass
+
+def _record(type, objectId, payload=""):
+    return RECORD.pack(type, objectId, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+def _readRecord(f):
+    ''' reads the record at the current position, returning (type, object id, payload) or None if it is truncated or corrupt '''
+    header = f.read(RECORD.size)
+    if len(header) < RECORD.size:
+        return None
+    type, objectId, length, crc = RECORD.unpack(header)
+    if type not in (PUT, DELETE, INDEX, END, BLOB, BLOB_INDEX):
+        return None
+    payload = f.read(length)
+    if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+        return None
+    return type, objectId, payload
+
+def _readIndexEntries(payload, version):
+    ''' returns the entries (object id, offset, size[, x, y, width, height[, blob keys]]) of the given index payload '''
+    entryStruct = INDEX_ENTRIES[version]
+    entries = []
+    offset = 0
+    while offset < len(payload):
+        e = entryStruct.unpack_from(payload, offset)
+        offset += entryStruct.size
+        if version >= 3:
+            numBlobs = e[-1]
+            keys = tuple(BLOB_KEY.unpack_from(payload, offset + i * BLOB_KEY.size)[0] for i in xrange(numBlobs))
+            offset += numBlobs * BLOB_KEY.size
+            e = e[:-1] + (keys,)
+        entries.append(e)
+    return entries
+
+class DocumentFile(object):
+    ''' a whiteboard document stored in an append-only file, which keeps track of the records it has written, such that
+        subsequent saves append only the objects that have changed (as indicated by their version) '''
+
+    def __init__(self, path, blobs=None):
+        ''' blobs: the BlobStore holding the blobs referenced by the objects, to which the blobs in the file are added '''
+        self.path = path
+        self.blobs = blobs
+        self.records = {} # object id -> (offset, size, object version, absolute extents, blob keys) of the current PUT record
+        self.blobRecords = {} # blob key -> (offset, size) of the current BLOB record
+        self.size = 0 # size of the valid part of the file
+        self.liveBytes = 0 # total size of the current PUT and BLOB records
+        self.rewriteRequired = True # whether the file must be written from scratch (does not exist, is corrupt or a legacy file)
+        self.legacyObjects = False # whether the objects in the file may be pickled (saved by a version before 4)
+        self.minGarbageBytes = 64 * 1024
+        self.lock = threading.Lock()
+
+    def load(self, deserialize):
+        ''' reads the document, yielding the objects (as returned by deserialize for each serialized object) as they are read.
+            Files in the legacy format (a pickled dict of serialized objects) are imported; for these and for files of
+            versions before 4 (see legacyObjects), deserialize must accept pickled objects '''
+        with self.lock:
+            if not self.open():
+                log.info("importing legacy document %s", self.path)
+                self.legacyObjects = True
+                f = open(self.path, "rb")
+                try:
+                    d = pickle.load(f)
+                finally:
+                    f.close()
+                for s in d["objects"]:
+                    yield deserialize(s)
+                return
+            f = open(self.path, "rb")
+            try:
+                for objectId, (offset, size, version, rect, blobKeys) in sorted(self.records.iteritems(), key=lambda e: e[1][0]):
+                    obj = deserialize(self.readPayload(f, offset))
+                    r = obj.absRect()
+                    self.records[objectId] = (offset, size, obj.version, (r.x, r.y, r.width, r.height), tuple(obj.blobKeys()))
+                    yield obj
+            finally:
+                f.close()
+
+    def open(self):
+        ''' reads the index (or, if it is not intact, recovers the valid records), returning False if the file is
+            not in this format (but a legacy file) '''
+        self.records = {}
+        self.blobRecords = {}
+        self.size = self.liveBytes = 0
+        self.rewriteRequired = True
+        self.legacyObjects = False
+        f = open(self.path, "rb")
+        try:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+                return False
+            version = HEADER.unpack(header)[1]
+            if version not in INDEX_ENTRIES:
+                raise FormatError("unsupported document version %d" % version)
+            self.legacyObjects = version < 4
+            entries, blobEntries, self.size = self._readIndex(f, version)
+            if entries is None:
+                log.warning("document %s has no valid index; recovering records", self.path)
+                entries, blobEntries, self.size = self._scan(f)
+            else:
+                self.rewriteRequired = version != VERSION
+        finally:
+            f.close()
+        for e in entries:
+            # version None: as stored, i.e. unchanged; blob keys None: unknown (version 1/2 files have no blobs)
+            self.records[e[0]] = (e[1], e[2], None, e[3:7] if len(e) > 3 else None, e[7] if len(e) > 7 else None)
+            self.liveBytes += e[2]
+        for key, offset, size in blobEntries:
+            self.blobRecords[key] = (offset, size)
+            self.liveBytes += size
+            if self.blobs is not None:
+                self.blobs.addSource(key, lambda key=key: self.readBlob(key))
+        return True
+
+    def hasExtents(self):
+        ''' returns whether the extents of all objects are known, which is a prerequisite for lazy loading '''
+        return all(r[3] is not None for r in self.records.itervalues())
+
+    def readBlob(self, key):
+        ''' reads the data of the blob with the given key, returning None if the document does not contain it '''
+        for attempt in xrange(2): # the file may have been rewritten concurrently, moving the record
+            record = self.blobRecords.get(key)
+            if record is None:
+                return None
+            f = open(self.path, "rb")
+            try:
+                f.seek(record[0])
+                blob = _readRecord(f)
+            finally:
+                f.close()
+            if blob is not None and blob[0] == BLOB and blob[2][:BLOB_KEY.size] == key:
+                return blob[2][BLOB_KEY.size:]
+        raise FormatError("bad blob record at offset %d" % record[0])
+
+    def readPayload(self, f, offset):
+        ''' reads the payload of the PUT record at the given offset from f (a file or a memory map) '''
+        f.seek(offset)
+        record = _readRecord(f)
+        if record is None or record[0] != PUT:
+            raise FormatError("bad record at offset %d" % offset)
+        return record[2]
+
+    def _readIndex(self, f, version):
+        ''' reads the indices the END record at the end of the file points to, returning (entries, blob entries, file size)
+            or (None, None, None) '''
+        endPayload = END_PAYLOADS[version]
+        endSize = RECORD.size + endPayload.size
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < HEADER.size + endSize:
+            return None, None, None
+        f.seek(size - endSize)
+        end = _readRecord(f)
+        if end is None or end[0] != END:
+            return None, None, None
+        offsets = endPayload.unpack(end[2])
+        f.seek(offsets[0])
+        index = _readRecord(f)
+        if index is None or index[0] != INDEX:
+            return None, None, None
+        entries = _readIndexEntries(index[2], version)
+        blobEntries = []
+        if len(offsets) > 1:
+            f.seek(offsets[1])
+            blobIndex = _readRecord(f)
+            if blobIndex is None or blobIndex[0] != BLOB_INDEX:
+                return None, None, None
+            payload = blobIndex[2]
+            blobEntries = [BLOB_ENTRY.unpack_from(payload, i) for i in xrange(0, len(payload), BLOB_ENTRY.size)]
+        return entries, blobEntries, size
+
+    def _scan(self, f):
+        ''' reads all records up to the first invalid one, returning the index entries of the objects that were
+            not subsequently deleted (in the order of their records) and of the blobs along with the size of the
+            valid part of the file '''
+        f.seek(HEADER.size)
+        offset = HEADER.size
+        puts = {}
+        blobs = {}
+        while True:
+            record = _readRecord(f)
+            if record is None:
+                break
+            type, objectId, payload = record
+            size = RECORD.size + len(payload)
+            if type == PUT:
+                puts[objectId] = (offset, size)
+            elif type == DELETE:
+                puts.pop(objectId, None)
+            elif type == BLOB:
+                blobs[payload[:BLOB_KEY.size]] = (offset, size)
+            offset += size
+        entries = sorted(((objectId, o, s) for objectId, (o, s) in puts.iteritems()), key=lambda e: e[1])
+        return entries, [(key, o, s) for key, (o, s) in blobs.iteritems()], offset
+
+    def save(self, objects, keep=()):
+        ''' saves the given objects (which must have the attributes id and version and the methods serialize, absRect and
+            blobKeys), appending only objects that have changed since they were last saved or loaded along with the blobs
+            they reference that are not yet in the file. The records of the objects with the ids in keep are retained
+            as they are; all other objects are considered deleted '''
+        with self.lock:
+            records = {}
+            changed = []
+            ids = set()
+            for o in objects:
+                ids.add(o.id)
+                record = self.records.get(o.id)
+                if record is not None and record[2] == o.version and not self.legacyObjects: # pickled records are not copied
+                    records[o.id] = record
+                else:
+                    # the version is captured before serializing, so concurrent changes are saved next time
+                    r = o.absRect()
+                    changed.append((o, o.version, (r.x, r.y, r.width, r.height), tuple(o.blobKeys())))
+            for objectId in keep:
+                record = self.records.get(objectId)
+                if record is not None:
+                    ids.add(objectId)
+                    records[objectId] = record
+            deleted = [objectId for objectId in self.records if objectId not in ids]
+            if len(changed) == 0 and len(deleted) == 0 and not self.rewriteRequired:
+                return
+            # the blobs referenced by the remaining objects (all blobs, if the references of a record are unknown)
+            referenced = set()
+            if any(r[4] is None for r in records.itervalues()):
+                referenced.update(self.blobRecords)
+            for r in records.itervalues():
+                referenced.update(r[4] or ())
+            for c in changed:
+                referenced.update(c[3])
+            blobRecords = dict((key, self.blobRecords[key]) for key in referenced if key in self.blobRecords)
+            newBlobs = [key for key in referenced if key not in self.blobRecords]
+            garbage = self.size - self.liveBytes
+            if self.rewriteRequired or (garbage > self.liveBytes and garbage > self.minGarbageBytes):
+                self._rewrite(records, changed, blobRecords, newBlobs)
+            else:
+                self._append(records, changed, deleted, blobRecords, newBlobs)
+            if self.blobs is not None: # the blobs that have been written no longer need to be held in memory
+                for key in newBlobs:
+                    if key in self.blobRecords:
+                        self.blobs.addSource(key, lambda key=key: self.readBlob(key))
+            self.legacyObjects = False
+
+    def _writeRecords(self, f, offset, records, changed, blobRecords, newBlobs):
+        for key in newBlobs:
+            data = self.blobs.get(key) if self.blobs is not None else None
+            if data is None:
+                log.warning("blob %s is not available and cannot be saved", key)
+                continue
+            record = _record(BLOB, 0, BLOB_KEY.pack(key) + data)
+            f.write(record)
+            blobRecords[key] = (offset, len(record))
+            offset += len(record)
+        for o, version, rect, blobKeys in changed:
+            data = _record(PUT, o.id, o.serialize())
+            f.write(data)
+            records[o.id] = (offset, len(data), version, rect, blobKeys)
+            offset += len(data)
+        entries = sorted(records.iteritems(), key=lambda e: e[1][0])
+        index = "".join(INDEX_ENTRY.pack(objectId, o, s, *(r + (len(k or ()),))) + "".join(BLOB_KEY.pack(key) for key in k or ())
+            for objectId, (o, s, v, r, k) in entries)
+        blobIndex = "".join(BLOB_ENTRY.pack(key, o, s) for key, (o, s) in sorted(blobRecords.iteritems(), key=lambda e: e[1][0]))
+        blobIndexOffset = offset + RECORD.size + len(index)
+        f.write(_record(INDEX, 0, index))
+        f.write(_record(BLOB_INDEX, 0, blobIndex))
+        f.write(_record(END, 0, END_PAYLOAD.pack(offset, blobIndexOffset)))
+        f.flush()
+        os.fsync(f.fileno())
+        self.records = records
+        self.blobRecords = blobRecords
+        self.liveBytes = sum(r[1] for r in records.itervalues()) + sum(r[1] for r in blobRecords.itervalues())
+        self.size = blobIndexOffset + RECORD.size + len(blobIndex) + END_SIZE
+
+    def _append(self, records, changed, deleted, blobRecords, newBlobs):
+        f = open(self.path, "r+b")
+        try:
+            f.seek(self.size)
+            f.truncate() # drop anything beyond the valid part
+            offset = self.size
+            for objectId in deleted:
+                data = _record(DELETE, objectId)
+                f.write(data)
+                offset += len(data)
+            self._writeRecords(f, offset, records, changed, blobRecords, newBlobs)
+        finally:
+            f.close()
+
+    def _rewrite(self, records, changed, blobRecords, newBlobs):
+        ''' writes the file from scratch (to a temporary file, which then replaces it), copying unchanged records
+            and retained blobs from the old file '''
+        tmpPath = self.path + ".tmp"
+        f = open(tmpPath, "wb")
+        try:
+            f.write(HEADER.pack(MAGIC, VERSION))
+            offset = HEADER.size
+            newRecords = {}
+            newBlobRecords = {}
+            if len(records) > 0 or len(blobRecords) > 0:
+                old = open(self.path, "rb")
+                try:
+                    for key, (o, s) in sorted(blobRecords.iteritems(), key=lambda e: e[1][0]):
+                        old.seek(o)
+                        f.write(old.read(s))
+                        newBlobRecords[key] = (offset, s)
+                        offset += s
+                    for objectId, (o, s, v, r, k) in sorted(records.iteritems(), key=lambda e: e[1][0]):
+                        old.seek(o)
+                        f.write(old.read(s))
+                        newRecords[objectId] = (offset, s, v, r, k)
+                        offset += s
+                finally:
+                    old.close()
+            self._writeRecords(f, offset, newRecords, changed, newBlobRecords, newBlobs)
+        finally:
+            f.close()
+        if os.name == "nt" and os.path.exists(self.path):
+            os.remove(self.path) # rename does not replace existing files on Windows
+        os.rename(tmpPath, self.path)
+        self.rewriteRequired = False
+
+class LazyLoader(object):
+    ''' provides the objects of a document on demand: the file is memory-mapped and, based on the extents in the index,
+        only the objects near the viewport are materialized (deserialized), while materialized objects that are no longer
+        near the viewport and have not changed since they were loaded or saved are released again, such that memory use
+        is bounded by the visible area rather than the size of the document '''
+
+    def __init__(self, document, deserialize, margin=512):
+        ''' document: an open DocumentFile whose extents are known (see DocumentFile.hasExtents) '''
+        self.document = document
+        self.deserialize = deserialize
+        self.margin = margin # objects within this distance of the viewport are materialized, within twice the distance retained
+        self.maxLoadTime = 0.01 # maximum time in seconds spent materializing objects per call to update
+        self.loaded = {} # object id -> materialized object
+        self.index = spatial.SpatialGrid(cellSize=1024)
+        self.lastViewport = None
+        self.lock = threading.RLock()
+        self.mm = None # None while the document is being saved
+        self.mapped = threading.Event() # set unless the document is being saved
+        self._map()
+
+    def _map(self):
+        if self.mm is not None:
+            self.mm.close()
+        f = open(self.document.path, "rb")
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.index.clear()
+        for objectId, record in self.document.records.iteritems():
+            self.index.insert(objectId, pygame.Rect(record[3]))
+        self.mapped.set()
+
+    def _acquireMapped(self):
+        ''' acquires the lock once the document is mapped, waiting for a save to complete '''
+        while True:
+            self.mapped.wait()
+            self.lock.acquire()
+            if self.mm is not None:
+                return
+            self.lock.release()
+
+    def update(self, viewport, addObject, removeObject):
+        ''' materializes the objects near the given viewport (passing them to addObject) and releases the ones that are no
+            longer needed (passing them to removeObject), returning True if objects are still pending due to the time limit;
+            nothing is done while the document is being saved '''
+        with self.lock:
+            if viewport == self.lastViewport or self.mm is None:
+                return False
+            t = time.time()
+            pending = False
+            for objectId in self.index.queryRect(viewport.inflate(2 * self.margin, 2 * self.margin)):
+                if objectId in self.loaded:
+                    continue
+                if time.time() - t > self.maxLoadTime:
+                    pending = True
+                    break
+                self._materialize(objectId, addObject)
+            retained = viewport.inflate(4 * self.margin, 4 * self.margin)
+            for objectId, obj in self.loaded.items():
+                if not obj.alive(): # deleted
+                    del self.loaded[objectId]
+                    self.index.remove(objectId)
+                else:
+                    record = self.document.records.get(objectId)
+                    if record is not None and record[2] == obj.version and not obj.absRect().colliderect(retained):
+                        del self.loaded[objectId]
+                        removeObject(obj)
+            if not pending:
+                self.lastViewport = viewport
+            return pending
+
+    def _materialize(self, objectId, addObject):
+        record = self.document.records[objectId]
+        obj = self.deserialize(self.document.readPayload(self.mm, record[0]))
+        self.document.records[objectId] = (record[0], record[1], obj.version, record[3], record[4])
+        self.loaded[objectId] = obj
+        addObject(obj)
+        return obj
+
+    def materialize(self, objectId, addObject):
+        ''' materializes the object with the given id if it is part of the document but not currently materialized
+            (e.g. in order to apply a change to it), returning the object or None if there is no such object '''
+        self._acquireMapped()
+        try:
+            if objectId in self.loaded or objectId not in self.index or objectId not in self.document.records:
+                return None
+            return self._materialize(objectId, addObject)
+        finally:
+            self.lock.release()
+
+    def unloadedIds(self):
+        with self.lock:
+            return [objectId for objectId in self.document.records if objectId not in self.loaded and objectId in self.index]
+
+    def serializedUnloadedObjects(self):
+        ''' returns the serialized objects that are not currently materialized '''
+        self._acquireMapped()
+        try:
+            return [self.document.readPayload(self.mm, self.document.records[objectId][0]) for objectId in self.unloadedIds()]
+        finally:
+            self.lock.release()
+
+    def forget(self, objectId):
+        ''' marks the object with the given id as deleted if it is not currently materialized '''
+        with self.lock:
+            if objectId not in self.loaded:
+                self.index.remove(objectId)
+
+    def save(self, objects, path=None):
+        ''' saves the given (materialized) objects to the document, retaining the objects that are not materialized;
+            if a path other than the document's is given, the document is copied there first and saved to the copy.
+            The lock is not held while the file is written, such that update does not block (it does nothing meanwhile) '''
+        self._acquireMapped()
+        try:
+            keep = self.unloadedIds()
+            # the file cannot be truncated or replaced while it is mapped (on Windows)
+            self.mapped.clear()
+            self.mm.close()
+            self.mm = None
+        finally:
+            self.lock.release()
+        try:
+            if path is not None and path != self.document.path:
+                with self.document.lock:
+                    shutil.copyfile(self.document.path, path)
+                    self.document.path = path
+            self.document.save(objects, keep=keep)
+            with self.lock:
+                for o in objects:
+                    self.loaded[o.id] = o
+        finally:
+            with self.lock:
+                self._map()
+                self.lastViewport = None
+
+if __name__=='__main__':
+    # benchmark: full versus incremental saves and the time until the first object of a large document is available
+    import random
+    import tempfile
+    import time
+
+    RECT = struct.Struct("!iiii")
+    class Obj(object):
+        def __init__(self, id, data):
+            self.id = id
+            self.version = 0
+            self.data = data
+        def serialize(self):
+            return self.data
+        def absRect(self):
+            return pygame.Rect(RECT.unpack_from(self.data))
+        def blobKeys(self):
+            return []
+        def alive(self):
+            return True
+
+    logging.basicConfig()
+    random.seed(0)
+    n = 20000
+    extent = 100000
+    objs = [Obj(float(i), RECT.pack(random.randint(0, extent), random.randint(0, extent), 200, 100) + os.urandom(random.randint(200, 2000))) for i in xrange(n)]
+    path = os.path.join(tempfile.gettempdir(), "docfile-benchmark.wyb")
+    pickled = path + ".pickle"
+    if os.path.exists(path): os.remove(path)
+
+    t = time.time()
+    f = open(pickled, "wb")
+    pickle.dump({"objects": [o.serialize() for o in objs]}, f)
+    f.close()
+    print "legacy pickle save:         %8.1f ms" % ((time.time() - t) * 1e3)
+    doc = DocumentFile(path)
+    t = time.time()
+    doc.save(objs)
+    print "full save:                  %8.1f ms (%d bytes)" % ((time.time() - t) * 1e3, doc.size)
+    for o in random.sample(objs, 10):
+        o.data = o.data[:RECT.size] + os.urandom(500)
+        o.version += 1
+    t = time.time()
+    doc.save(objs)
+    print "incremental save (10 obj):  %8.1f ms (%d bytes)" % ((time.time() - t) * 1e3, doc.size)
+
+    t = time.time()
+    f = open(pickled, "rb")
+    d = pickle.load(f)
+    f.close()
+    print "legacy pickle load:         %8.1f ms" % ((time.time() - t) * 1e3)
+    t = time.time()
+    loaded = DocumentFile(path).load(lambda s: Obj(None, s))
+    loaded.next()
+    print "streaming load, first obj:  %8.1f ms" % ((time.time() - t) * 1e3)
+    count = 1 + sum(1 for o in loaded)
+    print "streaming load, all %d:  %8.1f ms" % (count, (time.time() - t) * 1e3)
+
+    t = time.time()
+    doc = DocumentFile(path)
+    doc.open()
+    loader = LazyLoader(doc, lambda s: Obj(None, s))
+    materialized = []
+    loader.maxLoadTime = 1
+    loader.update(pygame.Rect(50000, 50000, 1600, 1200), materialized.append, materialized.remove)
+    print "lazy open and first viewport: %6.1f ms, %d of %d objects materialized" % ((time.time() - t) * 1e3, len(materialized), count)
+    for i in xrange(1, 51): # pan across the board
+        loader.update(pygame.Rect(50000 + 500 * i, 50000, 1600, 1200), materialized.append, materialized.remove)
+    print "after panning 25000 units:  %d objects materialized" % len(materialized)
+    loader.mm.close()
+
+    f = open(path, "r+b") # simulate a truncated write
+    f.truncate(doc.size - 100)
+    f.close()
+    print "objects recovered from truncated file: %d" % sum(1 for o in DocumentFile(path).load(lambda s: Obj(None, s)))
+
+    # blob deduplication: many objects referencing few distinct images (e.g. a screenshot pasted repeatedly)
+    import blobstore
+    class BlobObj(Obj):
+        def __init__(self, id, key, blob):
+            Obj.__init__(self, id, RECT.pack(0, 0, 200, 100) + (key if key is not None else blob))
+            self.key = key
+        def blobKeys(self):
+            return [self.key] if self.key is not None else []
+    blobs = blobstore.BlobStore()
+    images = [os.urandom(100000) for i in xrange(10)]
+    keys = [blobs.put(image) for image in images]
+    for name, objs in (("inline", [BlobObj(float(i), None, images[i % 10]) for i in xrange(200)]),
+            ("blobs", [BlobObj(float(i), keys[i % 10], None) for i in xrange(200)])):
+        os.remove(path)
+        doc = DocumentFile(path, blobs)
+        doc.save(objs)
+        print "200 images (10 distinct), %6s: %8d bytes" % (name, doc.size)
+    os.remove(path)
+    os.remove(pickled)
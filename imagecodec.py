@@ -0,0 +1,178 @@
+# (C) 2014 by Dominik Jain (djain@gmx.net)
+
+import zlib
+import threading
+import Queue
+import StringIO
+import logging
+import pygame
+
+log = logging.getLogger(__name__)
+
+class Codec(object):
+    ''' encodes surfaces as strings and decodes them again '''
+
+    name = None # the name under which the codec is registered (and encoded images refer to it)
+
+    def encode(self, surface):
+        raise NotImplementedError()
+
+    def decode(self, data, size):
+        raise NotImplementedError()
+
+class ZlibCodec(Codec):
+    ''' lossless encoding of the raw pixel data in one of pygame's string formats ("RGB", "RGBA"), compressed with zlib;
+        the codec named "RGBA" is the one used by earlier versions '''
+
+    def __init__(self, format, level=6):
+        self.name = self.format = format
+        self.level = level
+
+    def encode(self, surface):
+        return zlib.compress(pygame.image.tostring(surface, self.format), self.level)
+
+    def decode(self, data, size):
+        return pygame.image.frombuffer(zlib.decompress(data), size, self.format)
+
+class PngCodec(Codec):
+    ''' lossless PNG encoding, whose filters compress screenshots and drawings much better than plain zlib '''
+
+    name = "PNG"
+
+    def encode(self, surface):
+        f = StringIO.StringIO()
+        pygame.image.save(surface, f, "image.png")
+        return f.getvalue()
+
+    def decode(self, data, size):
+        return pygame.image.load(StringIO.StringIO(data), "image.png")
+
+    @staticmethod
+    def isSupported():
+        ''' returns whether pygame can save PNG files to file objects (requires pygame 2 with extended image support) '''
+        if not pygame.image.get_extended():
+            return False
+        try:
+            PngCodec().encode(pygame.Surface((1, 1)))
+            return True
+        except Exception:
+            return False
+
+codecs = {} # name -> codec
+
+def register(codec):
+    codecs[codec.name] = codec
+
+register(ZlibCodec("RGBA"))
+register(ZlibCodec("RGB"))
+register(PngCodec())
+
+_pngSupported = None
+
+def hasAlpha(surface):
+    return bool(surface.get_flags() & pygame.SRCALPHA) or surface.get_colorkey() is not None
+
+def chooseCodec(surface):
+    ''' returns the codec to use for the given surface: PNG if it is supported (and the surface has no colour key,
+        which PNG encoding would lose), otherwise zlib on RGB or RGBA data depending on whether there is transparency '''
+    global _pngSupported
+    if _pngSupported is None:
+        _pngSupported = PngCodec.isSupported()
+    if _pngSupported and surface.get_colorkey() is None:
+        return codecs["PNG"]
+    return codecs["RGBA" if hasAlpha(surface) else "RGB"]
+
+previewSize = 256 # maximum width/height of previews
+minPreviewPixels = 1024 * 1024 # images with fewer pixels get no preview
+
+def needsPreview(surface):
+    width, height = surface.get_size()
+    return width * height >= minPreviewPixels
+
+def preview(surface, maxSize=None):
+    ''' returns a downscaled copy of the surface, whose width and height do not exceed maxSize '''
+    if maxSize is None: maxSize = previewSize
+    width, height = surface.get_size()
+    scale = min(1.0, float(maxSize) / max(width, height))
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    if surface.get_colorkey() is None and surface.get_bitsize() >= 24:
+        return pygame.transform.smoothscale(surface, size)
+    return pygame.transform.scale(surface, size)
+
+class BackgroundWorker(object):
+    ''' executes tasks one after the other on a background thread, which is started on demand '''
+
+    def __init__(self, name):
+        self.name = name
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, task, callback):
+        ''' schedules the execution of task(), whose result is passed to callback (on the worker thread) '''
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put((task, callback))
+
+    def _run(self):
+        while True:
+            task, callback = self.queue.get()
+            try:
+                callback(task())
+            except Exception:
+                log.exception("background task failed")
+
+# encodes images off the GUI thread
+worker = BackgroundWorker("image encoder")
+
+if __name__=='__main__':
+    # benchmark: encoded size and encoding/decoding time per codec for typical kinds of images
+    import os
+    import time
+    import numpy
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    numpy.random.seed(0)
+    size = (1920, 1080)
+
+    screenshot = pygame.Surface(size)
+    screenshot.fill((240, 240, 240))
+    for i in xrange(200): # windows, buttons and lines of text
+        x, y = numpy.random.randint(0, size[0]), numpy.random.randint(0, size[1])
+        colour = tuple(numpy.random.randint(0, 256, 3))
+        pygame.draw.rect(screenshot, colour, (x, y, numpy.random.randint(20, 400), numpy.random.randint(10, 300)))
+        pygame.draw.rect(screenshot, (0, 0, 0), (x + 5, y + 5, numpy.random.randint(20, 300), 8))
+    photo = pygame.Surface(size)
+    gradient = numpy.add.outer(numpy.arange(size[0]) / 8, numpy.arange(size[1]) / 8)
+    pixels = numpy.dstack((gradient % 256, (gradient / 2) % 256, numpy.zeros(gradient.shape))) + numpy.random.randint(0, 24, gradient.shape + (3,))
+    pygame.surfarray.blit_array(photo, numpy.clip(pixels, 0, 255).astype(numpy.uint8))
+    sprite = pygame.Surface((512, 512), flags=pygame.SRCALPHA)
+    sprite.fill((0, 0, 0, 0))
+    pygame.draw.circle(sprite, (200, 30, 30, 255), (256, 256), 200)
+
+    print "%-11s %6s %14s %12s %12s" % ("image", "codec", "size [bytes]", "encode [ms]", "decode [ms]")
+    for name, surface in (("screenshot", screenshot), ("photo", photo), ("alpha", sprite)):
+        raw = surface.get_width() * surface.get_height() * (4 if hasAlpha(surface) else 3)
+        print "%-11s %6s %14d" % (name, "raw", raw)
+        for codecName in ("RGB", "RGBA", "PNG"):
+            codec = codecs[codecName]
+            if codecName == "RGB" and hasAlpha(surface):
+                continue
+            t = time.time()
+            data = codec.encode(surface)
+            encodeTime = time.time() - t
+            t = time.time()
+            codec.decode(data, surface.get_size())
+            decodeTime = time.time() - t
+            marker = "*" if codec is chooseCodec(surface) else ""
+            print "%-11s %6s %14d %12.1f %12.1f %s" % ("", codecName, len(data), encodeTime * 1e3, decodeTime * 1e3, marker)
+        if needsPreview(surface):
+            t = time.time()
+            data = chooseCodec(surface).encode(preview(surface))
+            print "%-11s %6s %14d %12.1f" % ("", "prev.", len(data), (time.time() - t) * 1e3)
+    print "(* chosen codec)"
@@ -4,51 +4,232 @@ import asyncore
 import socket
 import logging
 import threading
-import pickle
 import hashlib
+import struct
+import collections
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
-class Dispatcher(asyncore.dispatcher_with_send):
+# every packet is sent in one or more frames, each of which consists of a header (lane, with the MORE_CHUNKS flag if
+# further chunks of the packet follow, and the length of the chunk) followed by the chunk (see Dispatcher)
+FRAME_HEADER = struct.Struct("!BI")
+MORE_CHUNKS = 0x80
+
+class Lane(object):
+    ''' the lanes packets are sent in, in order of priority: packets of different lanes are interleaved at the granularity
+        of chunks, while the packets within a lane retain their order '''
+    CURSOR, EDIT, BULK = range(3)
+
+class Dispatcher(asyncore.dispatcher):
+    ''' a connection that sends and receives packets. Packets are queued in lanes (see Lane) and split into chunks of at
+        most chunkSize bytes; whenever the socket can accept data, the next chunk is taken from the highest-priority lane
+        that is not empty, such that small packets are never delayed by more than a chunk of a large packet in a
+        lower-priority lane. The cursor lane is a low-volume lane for packets with a coalesce key (latest wins) '''
+
     def __init__(self, ipv6=False, sock=None):
-        asyncore.dispatcher_with_send.__init__(self, sock=sock)
+        self.sendLock = threading.Lock()
+        self.maxSendSize = 65536 # maximum number of bytes to pass to a single send call
+        self.chunkSize = 65536 # maximum size of a chunk of a packet
+        # the send queue must exist before the base class is initialised, as the latter may query writable
+        self.resetTransport()
+        asyncore.dispatcher.__init__(self, sock=sock)
         self.ipv6 = ipv6
-        self.terminator = "\r\n\r\n$end$\r\n\r\n"
-        self.recvBuffer = ""
         self.__debug = False
 
-    def send(self, data):
+    def resetTransport(self):
+        ''' discards all data that has not yet been sent or parsed, such that a new connection starts at a frame boundary '''
+        with self.sendLock:
+            self.sendQueue = collections.deque() # buffers of frames to be sent (staged from the lanes)
+            self.sendOffset = 0 # number of bytes of the first buffer that have already been sent
+            self.stagedBytes = 0 # number of bytes in the send queue that have not yet been sent
+            self.queuedBytes = 0 # number of bytes in the send queue and the lanes that have not yet been sent
+            self.lanes = {Lane.EDIT: collections.deque(), Lane.BULK: collections.deque()} # lane -> packets not yet (completely) staged
+            self.laneOffsets = {Lane.EDIT: 0, Lane.BULK: 0} # lane -> number of bytes of the lane's first packet that have been staged
+            self.latestFrames = collections.OrderedDict() # cursor lane: key -> latest packet for that key
+        self.recvBuffer = bytearray(65536)
+        self.recvView = memoryview(self.recvBuffer)
+        self.recvStart = 0 # start of the data that has not yet been parsed
+        self.recvEnd = 0 # end of the data that has been received
+        self.recvChunks = {} # lane -> chunks of the packet that is being received in the lane
+
+    def sendFrame(self, data, lane=Lane.EDIT):
         log.debug("sending packet; size %d" % len(data))
         if self.__debug:
             log.debug("hash: %s", hashlib.sha224(data).hexdigest())
-        # NOTE: explicitly *not* calling asyncore.dispatcher_with_send.send, because it's not thread-safe
-        # Instead, we just add to the output buffer, such that actual sending will take place only from one thread: the one running in asyncore.loop
-        self.out_buffer = self.out_buffer + data + self.terminator
+        # NOTE: we just add to the lane, such that actual sending will take place only from one thread: the one running in asyncore.loop
+        with self.sendLock:
+            self.lanes[lane].append(data)
+            self.queuedBytes += len(data)
+        wakeNetworkThread()
+
+    def getQueuedBytes(self):
+        ''' returns the number of bytes that have been queued but not yet sent '''
+        return self.queuedBytes
+
+    def sendLatest(self, key, data):
+        ''' queues a packet in the cursor lane; a packet with the same key that has not yet been sent is replaced (latest wins) '''
+        with self.sendLock:
+            self.latestFrames[key] = data
+        wakeNetworkThread()
+
+    def send(self, data, coalesceKey=None, lane=Lane.EDIT):
+        if coalesceKey is not None:
+            self.sendLatest(coalesceKey, data)
+        else:
+            self.sendFrame(data, lane)
+
+    def writable(self):
+        return (not self.connected) or len(self.sendQueue) > 0 or len(self.latestFrames) > 0 or any(len(q) > 0 for q in self.lanes.itervalues())
+
+    def handle_write(self):
+        self.flushSendQueue()
+
+    def _nextFrame(self):
+        ''' removes the next chunk to be sent from the lanes, returning (header, chunk) or None if all lanes are empty '''
+        if len(self.latestFrames) > 0:
+            data = self.latestFrames.popitem(last=False)[1]
+            self.queuedBytes += len(data)
+            return FRAME_HEADER.pack(Lane.CURSOR, len(data)), data
+        for lane in (Lane.EDIT, Lane.BULK):
+            queue = self.lanes[lane]
+            if len(queue) == 0:
+                continue
+            data = queue[0]
+            offset = self.laneOffsets[lane]
+            size = min(self.chunkSize, len(data) - offset)
+            more = offset + size < len(data)
+            chunk = data if offset == 0 and not more else memoryview(data)[offset:offset + size]
+            if more:
+                self.laneOffsets[lane] += size
+            else:
+                queue.popleft()
+                self.laneOffsets[lane] = 0
+            return FRAME_HEADER.pack(lane | (MORE_CHUNKS if more else 0), size), chunk
+        return None
+
+    def _stageFrames(self):
+        ''' moves frames from the lanes to the send queue until it holds enough data for a send call '''
+        while self.stagedBytes < self.maxSendSize:
+            frame = self._nextFrame()
+            if frame is None:
+                break
+            for buf in frame:
+                if len(buf) > 0:
+                    self.sendQueue.append(buf)
+                    self.stagedBytes += len(buf)
+            self.queuedBytes += FRAME_HEADER.size
+
+    def _nextSendBuffers(self):
+        ''' returns the list of buffers to pass to the next send call (all of which are at the head of the send queue) '''
+        head = self.sendQueue[0]
+        if len(head) - self.sendOffset >= self.maxSendSize:
+            return [memoryview(head)[self.sendOffset:self.sendOffset + self.maxSendSize]]
+        buffers = [head[self.sendOffset:] if self.sendOffset > 0 else head]
+        size = len(buffers[0])
+        for i in xrange(1, len(self.sendQueue)):
+            chunk = self.sendQueue[i]
+            if size + len(chunk) > self.maxSendSize:
+                break
+            buffers.append(chunk)
+            size += len(chunk)
+        return buffers
+
+    def _sendBuffers(self, buffers):
+        ''' sends the given buffers with a single system call, returning the number of bytes sent '''
+        if len(buffers) == 1:
+            return asyncore.dispatcher.send(self, buffers[0])
+        if not hasattr(self.socket, "sendmsg"): # no writev available, so gather the (small) chunks instead
+            return asyncore.dispatcher.send(self, "".join(b if type(b) == str else b.tobytes() for b in buffers))
+        try:
+            return self.socket.sendmsg(buffers)
+        except socket.error, why:
+            if why.args[0] == asyncore.EWOULDBLOCK:
+                return 0
+            elif why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+
+    def flushSendQueue(self):
+        with self.sendLock:
+            self._stageFrames()
+            if len(self.sendQueue) == 0:
+                return
+            buffers = self._nextSendBuffers()
+        sent = self._sendBuffers(buffers)
+        if not sent:
+            return
+        with self.sendLock:
+            self.queuedBytes -= sent
+            self.stagedBytes -= sent
+            sent += self.sendOffset
+            while sent > 0:
+                headSize = len(self.sendQueue[0])
+                if sent < headSize:
+                    break
+                self.sendQueue.popleft()
+                sent -= headSize
+            self.sendOffset = sent
 
     def createSocket(self):
         self.create_socket(socket.AF_INET6 if self.ipv6 else socket.AF_INET, socket.SOCK_STREAM)
 
+    def _recvInto(self, view):
+        ''' receives data directly into the given buffer, returning the number of bytes read (0 if the connection was closed) '''
+        try:
+            n = self.socket.recv_into(view)
+        except socket.error, why:
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+        if n == 0:
+            self.handle_close()
+        return n
+
+    def _reserve(self, size):
+        ''' makes sure that the receive buffer can hold the given number of bytes starting at the current parse position '''
+        if self.recvStart + size <= len(self.recvBuffer):
+            return
+        pending = self.recvEnd - self.recvStart
+        if size > len(self.recvBuffer):
+            buf = bytearray(max(size, 2 * len(self.recvBuffer)))
+            buf[:pending] = self.recvView[self.recvStart:self.recvEnd]
+            self.recvBuffer = buf
+            self.recvView = memoryview(buf)
+        else:
+            self.recvBuffer[:pending] = self.recvView[self.recvStart:self.recvEnd].tobytes()
+        self.recvStart = 0
+        self.recvEnd = pending
+
     def handle_read(self):
-        d = self.recv(8192)
-        if d == "": # connection closed from other end
+        if self.recvEnd == len(self.recvBuffer):
+            self._reserve(len(self.recvBuffer) - self.recvStart + 1)
+        n = self._recvInto(self.recvView[self.recvEnd:])
+        if n == 0:
             return
-        self.recvBuffer += d
-        log.debug("recvBuffer size: %d" % len(self.recvBuffer))
-        while True:
-            try:
-                tpos = self.recvBuffer.index(self.terminator)
-            except:
+        self.recvEnd += n
+        headerSize = FRAME_HEADER.size
+        while self.recvEnd - self.recvStart >= headerSize:
+            flags, length = FRAME_HEADER.unpack_from(self.recvBuffer, self.recvStart)
+            frameEnd = self.recvStart + headerSize + length
+            if frameEnd > self.recvEnd:
+                self._reserve(headerSize + length)
                 break
-            packet = self.recvBuffer[:tpos]
+            chunk = self.recvView[self.recvStart + headerSize:frameEnd].tobytes()
+            self.recvStart = frameEnd
+            lane = flags & ~MORE_CHUNKS
+            if flags & MORE_CHUNKS:
+                self.recvChunks.setdefault(lane, []).append(chunk)
+                continue
+            chunks = self.recvChunks.pop(lane, None)
+            packet = chunk if chunks is None else "".join(chunks) + chunk
             log.debug("received packet; size %d" % len(packet))
             if self.__debug: log.debug("hash: %s", hashlib.sha224(packet).hexdigest())
-            if len(packet) > 20000:
-                with file("bigdata.dat", "wb") as f:
-                    f.write(packet)
-                    f.close()
             self.handle_packet(packet)
-            self.recvBuffer = self.recvBuffer[tpos+len(self.terminator):]
+        if self.recvStart == self.recvEnd:
+            self.recvStart = self.recvEnd = 0
 
     def handle_packet(self, packet):
         ''' handles a read packet '''
@@ -77,15 +258,18 @@ class SyncServer(Dispatcher):
         # send initial data to new user
         self.delegate.handle_ClientConnected(conn)
 
-    def dispatch(self, d, exclude=None):
-        numClients = len(self.connections) if exclude is None else len(self.connections)-1
-        if type(d) == dict and "evt" in d:
-            evt = d["evt"]
-            if evt != "moveUserCursor":
-                log.debug("dispatching %s to %d clients" % (evt, numClients))
+    # connection interface
+
+    def dispatchPacket(self, packet, exclude=None, coalesceKey=None, lane=Lane.EDIT):
+        ''' sends the given (already encoded) packet to all connections in the given lane, sharing the same buffer among them;
+            if a coalesce key is given, the packet is sent in the cursor lane (see Dispatcher.sendLatest) '''
         for c in self.connections:
             if c != exclude:
-                c.dispatch(d)
+                if c.isOverloaded():
+                    log.warning("dropping slow client connection with %d bytes queued" % c.getQueuedBytes())
+                    c.drop()
+                else:
+                    c.send(packet, coalesceKey=coalesceKey, lane=lane)
 
     def removeConnection(self, conn):
         if not conn in self.connections:
@@ -97,9 +281,32 @@ class SyncServer(Dispatcher):
 
 class DispatcherConnection(Dispatcher):
     def __init__(self, connection, server):
+        self.highWaterMark = 64 * 1024 * 1024 # queued bytes beyond which the connection is dropped
+        self.dropRequested = False
         Dispatcher.__init__(self, sock=connection)
         self.syncserver = server
 
+    def isOverloaded(self):
+        return self.getQueuedBytes() > self.highWaterMark
+
+    def drop(self):
+        ''' requests that the connection be closed by the network thread '''
+        self.dropRequested = True
+        wakeNetworkThread()
+
+    def readable(self):
+        return not self.dropRequested and Dispatcher.readable(self)
+
+    def writable(self):
+        # a requested drop is carried out in handle_write, as the socket must not be closed while the loop is polling it
+        return self.dropRequested or Dispatcher.writable(self)
+
+    def handle_write(self):
+        if self.dropRequested:
+            self.handle_close()
+            return
+        Dispatcher.handle_write(self)
+
     def handle_packet(self, packet):
         log.debug("handling packet; size %d" % len(packet))
         if packet == "": # connection closed from other end
@@ -114,8 +321,10 @@ class DispatcherConnection(Dispatcher):
         self.remove()
         self.close()
 
-    def dispatch(self, d):
-        self.send(pickle.dumps(d))
+    # connection interface
+
+    def dispatchPacket(self, packet, coalesceKey=None, lane=Lane.EDIT):
+        self.send(packet, coalesceKey=coalesceKey, lane=lane)
 
 class SyncClient(Dispatcher):
     def __init__(self, server, port, delegate, ipv6=False):
@@ -129,6 +338,7 @@ class SyncClient(Dispatcher):
     def connectToServer(self):
         log.info("connecting to %s..." % str(self.serverAddress))
         self.connectingToServer = True
+        self.resetTransport() # data left over from a previous connection must not be sent on the new one
         self.createSocket()
         self.connect(self.serverAddress)
 
@@ -154,18 +364,77 @@ class SyncClient(Dispatcher):
 
     # connection interface
 
-    def dispatch(self, d, exclude=None):
+    def dispatchPacket(self, packet, exclude=None, coalesceKey=None, lane=Lane.EDIT):
         if not self.connectedToServer:
             return
-        if not (type(d) == dict and "ping" in d):
-            pass
-        self.send(pickle.dumps(d))
+        self.send(packet, coalesceKey=coalesceKey, lane=lane)
 
     def reconnect(self):
         self.connectToServer()
 
 
+def _socketPair():
+    ''' returns a pair of connected sockets (using a loopback connection where socket.socketpair is not available) '''
+    if hasattr(socket, "socketpair"):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        a = socket.create_connection(listener.getsockname())
+        b = listener.accept()[0]
+    finally:
+        listener.close()
+    a.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return a, b
+
+class Waker(asyncore.dispatcher):
+    ''' the receiving end of a socket pair in the network thread's map; other threads write to the other end in order
+        to interrupt the loop's select call, such that the data they have queued is sent right away rather than only
+        after the loop's timeout has expired '''
+
+    def __init__(self):
+        self.wakeSocket, sock = _socketPair()
+        self.wakeSocket.setblocking(False)
+        self.pending = False # whether a wake-up has been requested that the network thread has not yet received
+        self.closed = False
+        asyncore.dispatcher.__init__(self, sock=sock)
+
+    def wake(self):
+        if self.pending:
+            return
+        self.pending = True
+        try:
+            self.wakeSocket.send("\0")
+        except socket.error: # the socket's buffer is full (so the network thread is about to wake up anyway) or it was closed
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.pending = False # reset before receiving, such that no wake-up requested in the meantime is lost
+        self.recv(4096)
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self.closed = True
+        asyncore.dispatcher.close(self)
+        self.wakeSocket.close()
+
+waker = None # the Waker of the network thread
+
+def wakeNetworkThread():
+    ''' makes the network thread poll its sockets right away (to be called after queueing data to be sent) '''
+    if waker is not None:
+        waker.wake()
+
 def spawnNetworkThread():
+    global waker
+    if waker is None or waker.closed:
+        waker = Waker()
     networkThread = threading.Thread(target=lambda:asyncore.loop(timeout=0.1))
     networkThread.daemon = True
     networkThread.start()
@@ -180,3 +449,88 @@ def startClient(server, port, delegate, ipv6=False):
     log.info("connecting to %s:%d, IPv6: %s" % (server, port, ipv6))
     client = SyncClient(server, port, delegate, ipv6=ipv6)
     spawnNetworkThread()
+
+if __name__=='__main__':
+    # benchmark: relay throughput over loopback as a function of the number of clients
+    import time
+    import os
+    import pickle
+    log.setLevel(logging.WARNING)
+
+    class BenchmarkDelegate(object):
+        def setDispatcher(self, dispatcher): pass
+        def handle_ClientConnected(self, conn): pass
+        def handle_ClientConnectionLost(self, conn): pass
+        def handle_AllClientConnectionsLost(self): pass
+
+    def receiveAll(sock, numBytes):
+        while numBytes > 0:
+            numBytes -= len(sock.recv(min(numBytes, 1 << 20)))
+
+    port = 27001
+    server = SyncServer(port, BenchmarkDelegate())
+    spawnNetworkThread()
+    payload = {"evt": "addObject", "args": (os.urandom(5 * 1024 * 1024),)}
+    numMessages = 3
+    packetSize = len(pickle.dumps(payload))
+    frameSize = packetSize + FRAME_HEADER.size * ((packetSize + server.chunkSize - 1) / server.chunkSize)
+    sockets = []
+    print "%8s %18s %18s" % ("clients", "per-client [MB/s]", "broadcast [MB/s]")
+    for numClients in (1, 5, 10, 30):
+        while len(sockets) < numClients:
+            s = socket.create_connection(("localhost", port))
+            sockets.append(s)
+        while len(server.connections) < numClients:
+            time.sleep(0.01)
+        results = []
+        for perClient in (True, False):
+            readers = [threading.Thread(target=receiveAll, args=(s, frameSize * numMessages)) for s in sockets]
+            for r in readers: r.start()
+            t = time.time()
+            for i in xrange(numMessages):
+                if perClient: # serialize separately for each client (the previous behaviour)
+                    for c in server.connections:
+                        c.send(pickle.dumps(payload))
+                else:
+                    server.dispatchPacket(pickle.dumps(payload))
+            for r in readers: r.join()
+            results.append(frameSize * numMessages * numClients / (time.time() - t) / 1e6)
+        print "%8d %18.1f %18.1f" % (numClients, results[0], results[1])
+
+    # delay of small packets sent while a bulk transfer is in flight over a slow link (about 4 MB/s)
+    bulkSize = 8 * 1024 * 1024
+    numSmall = 20
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+    s.connect(("localhost", port))
+    while len(server.connections) < len(sockets) + 1:
+        time.sleep(0.01)
+    conn = server.connections[-1]
+    conn.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+    TIME = struct.Struct("!d")
+    print
+    print "%-12s %18s %18s" % ("bulk lane", "mean delay [ms]", "max delay [ms]")
+    for bulkLane, name in ((Lane.EDIT, "edit (FIFO)"), (Lane.BULK, "bulk")):
+        delays = []
+        def receiveSlowly():
+            buf = ""
+            while len(delays) < numSmall:
+                buf += s.recv(16384)
+                time.sleep(0.004)
+                while len(buf) >= FRAME_HEADER.size:
+                    flags, length = FRAME_HEADER.unpack_from(buf)
+                    if len(buf) < FRAME_HEADER.size + length:
+                        break
+                    if flags == Lane.EDIT and length == TIME.size:
+                        delays.append(time.time() - TIME.unpack_from(buf, FRAME_HEADER.size)[0])
+                    buf = buf[FRAME_HEADER.size + length:]
+        reader = threading.Thread(target=receiveSlowly)
+        reader.start()
+        conn.send(os.urandom(bulkSize), lane=bulkLane)
+        for i in xrange(numSmall):
+            conn.send(TIME.pack(time.time()))
+            time.sleep(0.05)
+        reader.join()
+        print "%-12s %18.1f %18.1f" % (name, sum(delays) / len(delays) * 1e3, max(delays) * 1e3)
+    asyncore.close_all()
+    time.sleep(0.5) # let the network thread terminate
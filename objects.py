@@ -1,20 +1,61 @@
 # (C) 2014 by Dominik Jain (djain@gmx.net)
 
 import time
+import sys
+import array
+import collections
+import threading
 import pygame
 from pygame import sprite
 import numpy
-import objects
+import math
+import re
+import struct
 import pickle
-import threading
 import aaline
+import polyline
 import logging 
+import blobstore
+import imagecodec
+import protocol
 
 log = logging.getLogger(__name__)
 
-def deserialize(s, game):
-    d = pickle.loads(s)
-    return eval("%s(d, game)" % d["class"])    
+def deserialize(s, game, legacy=False):
+    ''' reconstructs an object from its serialized form (see encodeObject); legacy: whether s may be a pickled
+        dictionary as saved by earlier versions (which must never be accepted from the network) '''
+    cls, d = decodeObject(s, legacy)
+    return cls(d, game)
+
+def _pointsToString(points):
+    ''' returns the coordinates of a point array as raw little-endian 32-bit integers '''
+    if sys.byteorder == "big":
+        points = array.array("i", points)
+        points.byteswap()
+    return points.tostring()
+
+def _pointsFromString(s):
+    a = array.array("i")
+    a.fromstring(s)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+def pointArray(points):
+    ''' returns the given points (a sequence of pairs or an existing point array) as a flat array of integer coordinates x0, y0, x1, y1, ... '''
+    if isinstance(points, array.array):
+        return points
+    a = array.array("i")
+    for x, y in points:
+        a.append(int(round(x)))
+        a.append(int(round(y)))
+    return a
+
+def scaleSurface(surface, size):
+    ''' scales the given surface to the given size, smoothly unless it uses a colour key (which would be blended into the edges) '''
+    if surface.get_colorkey() is None and surface.get_bitsize() >= 24:
+        return pygame.transform.smoothscale(surface, size)
+    return pygame.transform.scale(surface, size)
 
 class Alignment(object):
     TOP_LEFT, CENTRE, BOTTOM_LEFT = range(3)
@@ -22,7 +63,7 @@ class Alignment(object):
 class BaseObject(sprite.Sprite):
     ''' basic sprite object '''
     
-    def __init__(self, d, game, persistentMembers = None, isUserObject=False, layer=1, alignment=Alignment.TOP_LEFT):
+    def __init__(self, d, game, persistentMembers = None, isUserObject=False, layer=1, alignment=Alignment.TOP_LEFT, scaleWithZoom=None):
         self.isUserObject = isUserObject # can be overridden below if "isUserObject" is a persistent member 
         
         if persistentMembers is None: persistentMembers = []
@@ -34,6 +75,9 @@ class BaseObject(sprite.Sprite):
         self.alignment = alignment
         self.layer = layer
         self.id = time.time()
+        self.renderer = None # set by the renderer the object is added to
+        self.version = 0 # incremented whenever the object changes
+        self.movement = None
         
         for member in self.persistentMembers:
             if member in d:
@@ -51,35 +95,37 @@ class BaseObject(sprite.Sprite):
                     raise Exception("unknown alignment: %s" % self.alignment)
             else:
                 self.pos = (0, 0)
+
+        # whether the object is drawn at the camera's zoom (or at its original size, like mouse cursors)
+        self.scaleWithZoom = self.isUserObject if scaleWithZoom is None else scaleWithZoom
     
-    class MovementAnimationThread(threading.Thread):
-        def __init__(self, obj, pos, duration):
-            threading.Thread.__init__(self)
-            self.obj = obj
-            self.pos = pos
-            self.duration = duration
-            self.animating = True
-        
-        def run(self):
-            startPos = self.obj.pos
-            translation = numpy.array(self.pos) - startPos
-            startTime = time.time()
-            while self.animating:
-                passed = min(time.time() - startTime, self.duration)
-                self.obj.pos = startPos + (passed / self.duration) * translation
-                if passed == self.duration:
-                    break
-                time.sleep(0.010)
-    
-    def animateMovement(self, pos, duration):
-        if hasattr(self, "movementAnimationThread"):
-            self.movementAnimationThread.animating = False
-        self.movementAnimationThread = BaseObject.MovementAnimationThread(self, pos, duration)
-        self.movementAnimationThread.start()
+    def animateMovement(self, pos, duration, startTime=None):
+        ''' starts a linear movement from the current position to the given position, which is
+            evaluated by calls to updateMovement (in the render loop) '''
+        if startTime is None: startTime = time.time()
+        startPos = numpy.array(self.pos, dtype=float)
+        self.movement = (startPos, numpy.array(pos) - startPos, startTime, duration)
+
+    def updateMovement(self, now):
+        ''' applies the current movement for the given point in time, returning whether the movement is still ongoing '''
+        movement = self.movement
+        if movement is None:
+            return False
+        startPos, translation, startTime, duration = movement
+        if now - startTime < duration:
+            self.pos = startPos + ((now - startTime) / duration) * translation
+            return True
+        self.pos = startPos + translation
+        if self.movement is movement:
+            self.movement = None
+        return False
+
+    def isAnimating(self):
+        return self.movement is not None
     
     def update(self, game):
         # update the sprite's drawing position relative to the camera
-        coord = self.pos - game.camera.pos
+        coord = numpy.floor(game.camera.worldToScreen(self.pos)) # rounded down as in absRect (a Rect would round towards zero)
         if self.alignment == Alignment.TOP_LEFT:
             self.rect.topleft = coord
         elif self.alignment == Alignment.CENTRE:
@@ -87,6 +133,24 @@ class BaseObject(sprite.Sprite):
         elif self.alignment == Alignment.BOTTOM_LEFT:
             self.rect.bottomleft = coord
     
+    def lodImage(self, zoom):
+        ''' returns the image to draw at the given zoom factor (the image scaled accordingly) '''
+        image = self.image
+        if zoom == 1:
+            return image
+        lod = self.__dict__.get("_lod")
+        if lod is None or lod[0] != zoom or lod[1] is not image:
+            lod = self._lod = (zoom, image, self._scaleImage(image, zoom))
+        return lod[2]
+
+    def _scaleImage(self, image, zoom):
+        width, height = image.get_size()
+        return scaleSurface(image, (max(1, int(math.ceil(width * zoom))), max(1, int(math.ceil(height * zoom)))))
+
+    def blobKeys(self):
+        ''' returns the keys of the blobs (in imageBlobs) the serialized object references '''
+        return []
+
     def collide(self, group, doKill=False, collided=None):
         return sprite.spritecollide(self, group, doKill, collided)
 
@@ -95,7 +159,15 @@ class BaseObject(sprite.Sprite):
         sprite.Sprite.kill(self)
 
     def offset(self, x, y):
-        self.pos += numpy.array([x,y])
+        self.pos = self.pos + numpy.array([x,y])
+        self.changed()
+
+    def changed(self):
+        ''' must be called whenever the object's absolute extents or its appearance have changed '''
+        self.version += 1
+        self._serialized = None
+        if self.renderer is not None:
+            self.renderer.objectChanged(self)
     
     def toDict(self):    	
         d = {
@@ -112,7 +184,7 @@ class BaseObject(sprite.Sprite):
     def _deserializeValue(self, name, value):
         evalTag = "_EVAL_:"
         if type(value) == str and value[:len(evalTag)] == evalTag:
-            value = eval(value[len(evalTag):])
+            value = _parseLegacyValue(value[len(evalTag):])
         return value
 
     def _stringToEval(self, s):
@@ -126,11 +198,18 @@ class BaseObject(sprite.Sprite):
         return value
 
     def serialize(self):
-        return pickle.dumps(self.toDict())
+        ''' returns the serialized object, which is cached until the object changes '''
+        cached = self.__dict__.get("_serialized")
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        version = self.version # captured first, such that a concurrent change invalidates the result
+        s = encodeObject(self)
+        self._serialized = (version, s)
+        return s
 
     def absRect(self):
         ''' returns a rectangle reflecting the abolute extents of the object '''
-        return pygame.Rect(self.pos[0], self.pos[1], self.rect.width, self.rect.height)
+        return pygame.Rect(numpy.floor(self.pos[0]), numpy.floor(self.pos[1]), self.rect.width, self.rect.height)
 
 class Rectangle(BaseObject):
     def __init__(self, d, game, **kwargs):
@@ -139,149 +218,324 @@ class Rectangle(BaseObject):
         self.setSize(self.rect.width, self.rect.height)
             
     def setSize(self, width, height):
-        width, height = max(1, width), max(1, height)
+        width, height = max(1, int(width)), max(1, int(height))
         alpha = len(self.colour) == 4
         surface = pygame.Surface((width, height), flags=pygame.SRCALPHA if alpha else 0)
         surface.fill(self.colour)
         self.image = surface.convert() if not alpha else surface.convert_alpha()
         self.rect.width = width
         self.rect.height = height
+        self.changed()
+
+# content-addressed store of the encoded pixel data of images, which serialized images reference by key, such that
+# an image is transferred and saved only once, no matter how many objects (or snapshots) contain it
+imageBlobs = blobstore.BlobStore()
 
 class Image(BaseObject):
     def __init__(self, d, game, persistentMembers = None, **kwargs):        
         if persistentMembers is None: persistentMembers = []
         BaseObject.__init__(self, d, game, persistentMembers=persistentMembers+["isUserObject", "image"], **kwargs)
 
-    def setSurface(self, surface, ppAlpha = False):
-        self.image = surface.convert() if not ppAlpha else surface.convert_alpha()
+    def setSurface(self, surface, ppAlpha = False, convert = True):
+        if convert:
+            surface = surface.convert() if not ppAlpha else surface.convert_alpha()
+        self.image = surface
         self.rect = self.image.get_rect()
+        self.changed()
+
+    def _scaleImage(self, image, zoom):
+        ''' scales down using a mipmap pyramid (successive halvings of the image), which is built on demand and
+            reused for all zoom factors below 1, such that only the smallest sufficient level is rescaled '''
+        if zoom >= 1:
+            return BaseObject._scaleImage(self, image, zoom)
+        mipmaps = self.__dict__.get("_mipmaps")
+        if mipmaps is None or mipmaps[0] is not image:
+            mipmaps = self._mipmaps = [image]
+        width, height = image.get_size()
+        size = (max(1, int(math.ceil(width * zoom))), max(1, int(math.ceil(height * zoom))))
+        level = 1
+        while zoom * 2**level <= 1 and (width >> level) >= size[0] and (height >> level) >= size[1]:
+            if level == len(mipmaps):
+                mipmaps.append(scaleSurface(mipmaps[-1], (max(1, width >> level), max(1, height >> level))))
+            level += 1
+        mipmap = mipmaps[level-1]
+        if mipmap.get_size() == size:
+            return mipmap
+        return scaleSurface(mipmap, size)
+
+    def blobKeys(self):
+        if "image" not in self.persistentMembers:
+            return []
+        return _blobKeys(self._blobReference())
+
+    def _blobReference(self):
+        ''' returns the reference to the blob holding the encoded image, encoding it if necessary '''
+        blob = self.__dict__.get("_blob")
+        if blob is None or blob[1] is not self.image:
+            image = self.image
+            self._setBlob(_encodeImage(image), image)
+            blob = self._blob
+        return blob[0]
+
+    def _setBlob(self, ref, image):
+        if self.image is image:
+            # images with the same content share a single surface
+            self.image = imageBlobs.setDecoded(ref["blob"], image)
+            self._bindBlob(ref, self.image)
+
+    def _bindBlob(self, ref, image):
+        ''' sets the blob reference the given image was decoded from, holding references to the blobs (see
+            BlobStore.acquire) until the object is killed or bound to another reference '''
+        imageBlobs.acquire(*_blobKeys(ref))
+        old = self.__dict__.get("_blob")
+        self._blob = (ref, image)
+        if old is not None:
+            imageBlobs.release(*_blobKeys(old[0]))
+
+    def kill(self):
+        blob = self.__dict__.pop("_blob", None)
+        if blob is not None:
+            imageBlobs.release(*_blobKeys(blob[0]))
+        BaseObject.kill(self)
+
+    def encodeAsync(self, callback):
+        ''' encodes the image on the background worker, calling callback(self) (on the worker thread) once it is done,
+            such that serializing the object no longer requires the (potentially slow) encoding '''
+        image = self.image
+        def encoded(ref):
+            self._setBlob(ref, image)
+            callback(self)
+        imagecodec.worker.submit(lambda: _encodeImage(image), encoded)
 
     def _serializeValue(self, name, value):
         if name == "image":
-            format = "RGBA"
-            s = pygame.image.tostring(self.image, format)
-            cs = s.encode("zlib")
-            print "compression: %d -> %d" % (len(s), len(cs))
-            return (cs, self.image.get_size(), format)
+            return dict(self._blobReference())
         return super(Image, self)._serializeValue(name, value)
 
     def _deserializeValue(self, name, value):
-        if name == "image" and type(value) == tuple:
-            dim = value[1:][0]
-            if dim[0] == 0 or dim[1] == 0:
-                return pygame.Surface((10,10)).convert()
-            return pygame.image.frombuffer(value[0].decode("zlib"), *value[1:])
+        if name == "image" and type(value) == dict: # reference to a blob
+            ref = value
+            size = tuple(ref["size"])
+            if ref["blob"] in imageBlobs:
+                image = imageBlobs.getDecoded(ref["blob"], lambda data: _decodeImage(data, size, ref["format"]))
+            else: # use a placeholder until the blob (or its preview) has been received
+                image = pygame.Surface(size).convert()
+                image.fill((224, 224, 224))
+                if "preview" in ref:
+                    imageBlobs.request(ref["preview"], lambda key: self._previewReceived(ref, key))
+                imageBlobs.request(ref["blob"], lambda key: self._blobReceived(ref, key))
+            self._bindBlob(ref, image)
+            return image
+        if name == "image" and type(value) == tuple: # encoded image, as persisted by earlier versions
+            return _decodeImage(*value)
         return super(Image, self)._deserializeValue(name, value)
 
+    def _blobReceived(self, ref, key):
+        size = tuple(ref["size"])
+        image = imageBlobs.getDecoded(key, lambda data: _decodeImage(data, size, ref["format"]))
+        self._bindBlob(ref, image)
+        self.setSurface(image, convert=False)
+
+    def _previewReceived(self, ref, key):
+        if ref["blob"] in imageBlobs: # the image itself is already there
+            return
+        preview = _decodeImage(imageBlobs.get(key), tuple(ref["previewSize"]), ref["format"])
+        image = scaleSurface(preview, tuple(ref["size"]))
+        self._bindBlob(ref, image)
+        self.setSurface(image, convert=False)
+
+def _blobKeys(ref):
+    ''' returns the keys of the blobs the given image reference points to '''
+    return [ref["blob"]] + ([ref["preview"]] if "preview" in ref else [])
+
+def _encodeImage(image):
+    ''' encodes the given image (and a preview of it, if it is large), adding the data to imageBlobs and returning the reference '''
+    codec = imagecodec.chooseCodec(image)
+    ref = {"blob": imageBlobs.put(codec.encode(image)), "size": image.get_size(), "format": codec.name}
+    if imagecodec.needsPreview(image):
+        preview = imagecodec.preview(image)
+        ref["preview"] = imageBlobs.put(codec.encode(preview))
+        ref["previewSize"] = preview.get_size()
+    return ref
+
+def _decodeImage(data, size, format):
+    if size[0] == 0 or size[1] == 0:
+        return pygame.Surface((10,10)).convert()
+    return imagecodec.codecs[format].decode(data, size)
+
 class ImageFromResource(Image):
     def __init__(self, filename, game, ppAlpha=False, **kwargs):
         Image.__init__(self, {}, game, **kwargs)        
         surface = pygame.image.load(filename)
         self.setSurface(surface, ppAlpha=ppAlpha)
 
+class SurfaceCache(object):
+    ''' a least recently used cache of surfaces, which evicts entries once their total size exceeds a budget in bytes '''
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.numBytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _size(self, surface):
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+    def get(self, key):
+        with self.lock:
+            surface = self.entries.pop(key, None)
+            if surface is not None:
+                self.entries[key] = surface # most recently used
+            return surface
+
+    def put(self, key, surface):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.numBytes -= self._size(old)
+            self.entries[key] = surface
+            self.numBytes += self._size(surface)
+            while self.numBytes > self.maxBytes and len(self.entries) > 1:
+                evictedKey, evicted = self.entries.popitem(last=False)
+                self.numBytes -= self._size(evicted)
+
+    def pop(self, key):
+        ''' removes the entry for the given key, returning its surface (or None if there was no such entry) '''
+        with self.lock:
+            surface = self.entries.pop(key, None)
+            if surface is not None:
+                self.numBytes -= self._size(surface)
+            return surface
+
+# rasterized strokes of point-based scribbles that are not currently being drawn
+strokeSurfaceCache = SurfaceCache(256 * 1024 * 1024)
+
 class ScribbleRenderer(object):
-    def __init__(self, scribble):    
+    ''' incrementally renders a stroke onto a surface that grows as required;
+        the surface covers the points' bounding box plus a margin, i.e. its top-left corner is at origin().
+        The surface is a subsurface of a larger backing store, whose capacity is doubled whenever the stroke
+        outgrows it, such that the cost of growth is amortized regardless of the direction in which the stroke extends '''
+
+    backgroundColour = (255, 0, 255) # colour key
+    
+    def __init__(self, scribble, surface=None, bounds=None, lastPoint=None):
         self.antialiasing = False
         self.margin = 2*scribble.lineWidth
         self.colour = scribble.colour
         self.lineWidth = scribble.lineWidth
-        surface = pygame.Surface((self.margin, self.margin), flags=pygame.SRCALPHA if self.antialiasing else 0) # TODO: aaline does not work with SRCALPHA!
-        self.backgroundColour = (255, 0, 255) if not self.antialiasing else (255, 255, 255, 0)
+        if self.antialiasing: self.backgroundColour = (255, 255, 255, 0)
+        if surface is None:
+            surface = self._createSurface(self.margin, self.margin)
+            self.isFirstPoint = True
+        else: # resume rendering onto a surface for the given bounds (minX, minY, maxX, maxY) that was rendered previously
+            self.minX, self.minY, self.maxX, self.maxY = bounds
+            self.lineStartPos = numpy.array(lastPoint)
+            self.isFirstPoint = False
+        self.store = self.surface = surface
+        self.storeOffset = (0, 0) # position of the surface within the backing store
+        self.inputBuffer = array.array("i")
+
+    def _createSurface(self, width, height):
+        surface = pygame.Surface((width, height), flags=pygame.SRCALPHA if self.antialiasing else 0) # TODO: aaline does not work with SRCALPHA!
         surface.fill(self.backgroundColour)
         if not self.antialiasing:
             surface.set_colorkey(self.backgroundColour)
-        self.surface = surface
-        self.isFirstPoint = True
-        self.obj = scribble
-        self.inputBuffer = []
+        return surface
         
+    def _start(self, x, y):
+        self.lineStartPos = numpy.array([x, y])
+        self.minX = self.maxX = x
+        self.minY = self.maxY = y
+        self.isFirstPoint = False
+
+    def origin(self):
+        ''' returns the position of the surface's top-left corner in the coordinate system of the points '''
+        return numpy.array([self.minX - self.margin/2, self.minY - self.margin/2])
+
     def addPoint(self, x, y, draw=True):
         if self.isFirstPoint:
-            self.lineStartPos = numpy.array([x, y])
-            self.translateOrigin = numpy.array([-x, -y])
-            self.minX = self.maxX = x
-            self.minY = self.maxY = y
-            self.isFirstPoint = False
+            self._start(x, y)
         
-        self.inputBuffer.append((x, y))
+        self.inputBuffer.append(x)
+        self.inputBuffer.append(y)
         
         if draw:
             self._processInputs()
     
     def addPoints(self, points):
-        for point in points:
-            self.addPoint(*point, draw=False)
+        points = pointArray(points)
+        if len(points) == 0:
+            return
+        if self.isFirstPoint:
+            self._start(points[0], points[1])
+        self.inputBuffer.extend(points)
         self._processInputs()
             
     def _processInputs(self):
-        padLeft = 0
-        padTop = 0
-
-        oldWidth = self.surface.get_width()
-        oldHeight = self.surface.get_height()
-        newWidth = oldWidth
-        newHeight = oldHeight
-
+        inputs = self.inputBuffer
+        if len(inputs) == 0:
+            return
+        
         # determine growth
-        for x, y in self.inputBuffer:
-            #print "\nminX=%d maxX=%d" % (self.minX, self.maxX)
-            #print "x=%d y=%d" % (x,y)
-            growRight = x - self.maxX if x > self.maxX else 0
-            growLeft = self.minX - x if x < self.minX else 0
-            growBottom = y - self.maxY if y > self.maxY else 0
-            growTop = self.minY - y if y < self.minY else 0
-
-            padLeft += growLeft
-            padTop += growTop
-
-            #print "grow: right=%d left=%d top=%d bottom=%d" % (growRight, growLeft, growTop, growBottom)
-            self.maxX = max(self.maxX, x)
-            self.maxY = max(self.maxY, y)
-            self.minX = min(self.minX, x)
-            self.minY = min(self.minY, y)
-            #print "new: minX=%d maxX=%d" % (self.minX, self.maxX)
-
-            newWidth += growLeft + growRight
-            newHeight += growBottom + growTop
-
-        # create new larger surface and copy old surface content
-        if newWidth > oldWidth or newHeight > oldHeight:
-            #print "newDim: (%d, %d)" % (newWidth, newHeight)
-            surface = pygame.Surface((newWidth, newHeight), pygame.SRCALPHA if self.antialiasing else 0)
-            surface.fill(self.backgroundColour)
-            if not self.antialiasing:
-                surface.set_colorkey(self.backgroundColour)
-            surface.blit(self.surface, (padLeft, padTop))
-            self.surface = surface
-
-        # translate pos
-        self.obj.offset(-padLeft, -padTop)
+        a = numpy.frombuffer(inputs, dtype=numpy.intc).reshape(-1, 2)
+        minX, minY = map(int, a.min(axis=0))
+        maxX, maxY = map(int, a.max(axis=0))
+        padLeft = max(0, self.minX - minX)
+        padTop = max(0, self.minY - minY)
+        padRight = max(0, maxX - self.maxX)
+        padBottom = max(0, maxY - self.maxY)
+        self.minX, self.minY = self.minX - padLeft, self.minY - padTop
+        self.maxX, self.maxY = self.maxX + padRight, self.maxY + padBottom
 
-        # draw new lines
-        for x, y in self.inputBuffer:
-            self._drawLineTo(x, y)
+        if padLeft or padTop or padRight or padBottom:
+            newWidth = self.surface.get_width() + padLeft + padRight
+            newHeight = self.surface.get_height() + padTop + padBottom
+            storeWidth, storeHeight = self.store.get_size()
+            x = self.storeOffset[0] - padLeft
+            y = self.storeOffset[1] - padTop
+            if x < 0 or y < 0 or x + newWidth > storeWidth or y + newHeight > storeHeight:
+                # create a new backing store with at least twice the capacity in each direction of growth,
+                # placing the slack on the side(s) in which the stroke is growing, and copy the old content
+                if x < 0 or x + newWidth > storeWidth:
+                    storeWidth = max(newWidth, 2 * storeWidth)
+                    x = self._slack(storeWidth - newWidth, padLeft, padRight)
+                if y < 0 or y + newHeight > storeHeight:
+                    storeHeight = max(newHeight, 2 * storeHeight)
+                    y = self._slack(storeHeight - newHeight, padTop, padBottom)
+                store = self._createSurface(storeWidth, storeHeight)
+                store.blit(self.surface, (x + padLeft, y + padTop))
+                self.store = store
+            self.storeOffset = (x, y)
+            self.surface = self.store.subsurface((x, y, newWidth, newHeight))
 
-        # apply new surface
-        self.obj.setSurface(self.surface, ppAlpha=self.antialiasing)
+        # draw new lines
+        if not self.antialiasing:
+            polyline.drawPolyline(self.surface, self.colour, inputs, self.lineWidth, origin=self.origin(), startPoint=self.lineStartPos)
+            self.lineStartPos = numpy.array(inputs[-2:])
+        else:
+            for i in xrange(0, len(inputs), 2):
+                self._drawLineTo(inputs[i], inputs[i+1])
 
         # reset input buffer
-        self.inputBuffer = []
+        self.inputBuffer = array.array("i")
 
     def _drawLineTo(self, x, y):
         # draw line
-        margin = self.margin
-        self.translateOrigin = -self.obj.pos + numpy.array([-margin, -margin])
-        #print "translateOrigin=%s" % str(self.translateOrigin)
-        marginTranslate = numpy.array([margin, margin])
-        pos1 = self.lineStartPos + self.translateOrigin + marginTranslate
-        pos2 = numpy.array([x, y]) + self.translateOrigin + marginTranslate
-        #print "drawing from %s to %s" % (str(pos1), str(pos2))
-        if not self.antialiasing:
-            pygame.draw.line(self.surface, self.colour, pos1, pos2, self.lineWidth)
-        else:
-            aaline.aaline(self.surface, self.colour, pos1, pos2, self.lineWidth)
+        origin = self.origin()
+        pos1 = self.lineStartPos - origin
+        pos2 = numpy.array([x, y]) - origin
+        aaline.aaline(self.surface, self.colour, pos1, pos2, self.lineWidth)
         self.lineStartPos = numpy.array([x, y])
 
+    @staticmethod
+    def _slack(slack, growBefore, growAfter):
+        ''' returns the amount of slack to place before the content along an axis, given the growth on either side '''
+        if growBefore and not growAfter:
+            return slack
+        if growAfter and not growBefore:
+            return 0
+        return slack / 2
+
     def end(self):
         self._processInputs()
         
@@ -299,21 +553,36 @@ class Scribble(Image):
     def addPoints(self, points):
         if not hasattr(self, "scribbleRenderer"):
             self.scribbleRenderer = ScribbleRenderer(self)
-        self.scribbleRenderer.addPoints(points)
+        renderer = self.scribbleRenderer
+        oldOrigin = None if renderer.isFirstPoint else renderer.origin()
+        renderer.addPoints(points)
+        if oldOrigin is not None:
+            self.pos = self.pos + (renderer.origin() - oldOrigin)
+        self.setSurface(renderer.surface, convert=False)
     
     def endDrawing(self):
-        self.scribbleRenderer.end()
+        renderer = self.scribbleRenderer
+        renderer.end()
+        self.setSurface(renderer.surface, ppAlpha=renderer.antialiasing) # tight copy, releasing the backing store
         del self.scribbleRenderer
 
 class PointBasedScribble(Scribble):
-    ''' a point-based scribble sprite, which, when persisted, is reconstructed from the individual points '''
+    ''' a point-based scribble sprite, which, when persisted, is reconstructed from the individual points;
+        the points are stored as a flat array of integer coordinates (see pointArray).
+        The stroke is rasterized only once it is first drawn; unless it is currently being drawn, the resulting surface
+        is held in strokeSurfaceCache, from which it may be evicted at any time (to be rasterized again on demand) '''
+    
+    liveImage = None # the surface of a stroke that is currently being drawn
+
     def __init__(self, d, game, startPoint=None):
         pos = None
         if "pos" in d:
             pos = self._deserializeValue("pos", d["pos"])
         if startPoint is None:
+            if "points" in d:
+                d["points"] = self._deserializeValue("points", d["points"])
             if "points" in d and len(d["points"]) > 0:
-                startPoint = d["points"][0]
+                startPoint = (d["points"][0], d["points"][1])
             else:
                 raise Exception('construction requires either startPoint or non-empty d["points"]"')
         else:
@@ -321,21 +590,125 @@ class PointBasedScribble(Scribble):
         Scribble.__init__(self, d, game, persistentMembers=["points"], startPoint=startPoint)
         self.persistentMembers.remove("image")
         self.persistentMembers.remove("rect")
+        self.bounds = None # (minX, minY, maxX, maxY) of the points
+        self.lodZooms = set() # zoom factors for which strokeSurfaceCache may hold a rendering
         if not hasattr(self, "points"):
-            self.points = []
+            self.points = array.array("i")
         else:
-            Scribble.addPoints(self, self.points)
+            self._extendBounds(self.points)
         if pos is not None:
             self.pos = pos
-    
+
+    def _getImage(self):
+        image = self.liveImage
+        if image is None:
+            image = strokeSurfaceCache.get(self)
+            if image is None:
+                image = self.rasterize()
+                strokeSurfaceCache.put(self, image)
+        return image
+
+    def _setImage(self, image):
+        self.liveImage = image
+
+    image = property(_getImage, _setImage)
+
+    def rasterize(self):
+        ''' renders the entire stroke, returning the resulting surface '''
+        renderer = ScribbleRenderer(self)
+        renderer.addPoints(self.points)
+        return renderer.surface.convert()
+
+    def lodImage(self, zoom):
+        ''' renders the stroke directly at the given zoom factor from its points (simplified to the resolution at that zoom),
+            caching the result in strokeSurfaceCache '''
+        if zoom == 1:
+            return self.image
+        image = strokeSurfaceCache.get((self, zoom))
+        if image is None:
+            image = self.rasterizeAt(zoom)
+            strokeSurfaceCache.put((self, zoom), image)
+            self.lodZooms.add(zoom)
+        return image
+
+    def rasterizeAt(self, zoom):
+        margin = 2 * self.lineWidth
+        origin = numpy.array([self.bounds[0] - margin/2, self.bounds[1] - margin/2])
+        size = (max(1, int(math.ceil(self.rect.width * zoom))), max(1, int(math.ceil(self.rect.height * zoom))))
+        surface = pygame.Surface(size)
+        surface.fill(ScribbleRenderer.backgroundColour)
+        surface.set_colorkey(ScribbleRenderer.backgroundColour)
+        points = (numpy.frombuffer(self.points, dtype=numpy.intc).reshape(-1, 2) - origin) * zoom
+        polyline.drawPolyline(surface, self.colour, polyline.simplify(points, 1.0), max(1, int(round(self.lineWidth * zoom))))
+        return surface.convert()
+
+    def _discardLods(self):
+        for zoom in list(self.lodZooms):
+            strokeSurfaceCache.pop((self, zoom))
+        self.lodZooms = set()
+
+    def _extendBounds(self, points):
+        ''' updates the bounding box, position and size for the given new points '''
+        a = numpy.frombuffer(points, dtype=numpy.intc).reshape(-1, 2)
+        minX, minY = map(int, a.min(axis=0))
+        maxX, maxY = map(int, a.max(axis=0))
+        margin = 2 * self.lineWidth
+        if self.bounds is None:
+            self.pos = numpy.array([minX - margin/2, minY - margin/2])
+        else:
+            minX, minY = min(minX, self.bounds[0]), min(minY, self.bounds[1])
+            maxX, maxY = max(maxX, self.bounds[2]), max(maxY, self.bounds[3])
+            self.pos = self.pos + numpy.array([minX - self.bounds[0], minY - self.bounds[1]])
+        self.bounds = (minX, minY, maxX, maxY)
+        self.rect.width = maxX - minX + margin
+        self.rect.height = maxY - minY + margin
+
     def addPoints(self, points):
-        self.points.extend(points)        
-        Scribble.addPoints(self, points)
+        points = pointArray(points)
+        if len(points) == 0:
+            return
+        if not hasattr(self, "scribbleRenderer"):
+            # if the stroke is currently rasterized, continue rendering onto the existing surface
+            surface = strokeSurfaceCache.pop(self)
+            if surface is not None:
+                self.scribbleRenderer = ScribbleRenderer(self, surface=surface, bounds=self.bounds, lastPoint=self.points[-2:])
+        self.points.extend(points)
+        self._extendBounds(points)
+        self._discardLods()
+        if hasattr(self, "scribbleRenderer"):
+            self.scribbleRenderer.addPoints(points)
+            self.liveImage = self.scribbleRenderer.surface
+        self.changed()
         #log.debug("relative points: %s", map(list, [numpy.array(p)-self.pos for p in self.points]))
+
+    def endDrawing(self):
+        if hasattr(self, "scribbleRenderer"):
+            self.scribbleRenderer.end()
+            strokeSurfaceCache.put(self, self.scribbleRenderer.surface.convert())
+            del self.scribbleRenderer
+            self.liveImage = None
+
+    def kill(self):
+        strokeSurfaceCache.pop(self)
+        self._discardLods()
+        Scribble.kill(self)
+
+    def _serializeValue(self, name, value):
+        if name == "points": # raw little-endian 32-bit integers
+            return _pointsToString(value)
+        return super(PointBasedScribble, self)._serializeValue(name, value)
+
+    def _deserializeValue(self, name, value):
+        if name == "points":
+            if type(value) == str:
+                return _pointsFromString(value)
+            return pointArray(value) # list of pairs, as persisted by earlier versions
+        return super(PointBasedScribble, self)._deserializeValue(name, value)
         
 class Text(Image):
     def __init__(self, d, game):
         Image.__init__(self, d, game, persistentMembers=["text", "colour", "fontSize", "fontName"], isUserObject=True)
+        self.persistentMembers.remove("image") # rendered from the text
         self.font = pygame.font.SysFont(self.fontName, self.fontSize)
         self.setText(self.text)
         
@@ -362,6 +735,292 @@ class Text(Image):
         
         self.setSurface(surface)
 
+# Serialized objects are encoded according to the schema registered for their class, which lays out the persistent
+# members in binary form. Documents saved by earlier versions contain pickled dictionaries of persistent members,
+# which are read only when importing such documents; their expressions (_EVAL_) are parsed rather than evaluated
+
+CODEC_VERSION = protocol.OBJECT_CODEC_VERSION # the first byte of an encoded object (pickled dictionaries start with "(")
+HEADER = struct.Struct("!BB") # codec version, type id of the schema
+LENGTH = struct.Struct("!I")
+IMAGE_REFERENCE = struct.Struct("!40s40sIIII") # blob key, preview key (empty if none), size, preview size; followed by the codec name
+
+class Field(object):
+    ''' the encoding of a persistent member '''
+
+    format = None # struct format of fixed-size fields
+
+    def get(self, obj, name):
+        return obj.__dict__[name]
+
+class FixedField(Field):
+    ''' a member of fixed size: pack maps the value to the tuple packed with the struct format, unpack maps it back '''
+
+    def __init__(self, format, pack, unpack):
+        self.format = format
+        self.count = len(struct.unpack("!" + format, "\0" * struct.calcsize("!" + format))) # number of packed values
+        self.pack = pack
+        self.unpack = unpack
+
+class StringField(Field):
+    ''' a member of variable size, which is encoded as a string '''
+
+    def __init__(self, encode, decode):
+        self.encode = encode
+        self.decode = decode
+
+class ImageField(StringField):
+    ''' an image, which is encoded as the reference to its blob '''
+
+    def __init__(self):
+        StringField.__init__(self, _encodeImageReference, _decodeImageReference)
+
+    def get(self, obj, name):
+        return obj._blobReference()
+
+def _encodeImageReference(ref):
+    previewSize = ref.get("previewSize", (0, 0))
+    return IMAGE_REFERENCE.pack(ref["blob"], ref.get("preview", ""), ref["size"][0], ref["size"][1], previewSize[0], previewSize[1]) + ref["format"]
+
+def _decodeImageReference(data):
+    blob, preview, width, height, previewWidth, previewHeight = IMAGE_REFERENCE.unpack_from(data)
+    ref = {"blob": blob, "size": (width, height), "format": str(data[IMAGE_REFERENCE.size:])}
+    if preview[0] != "\0":
+        ref["preview"] = preview
+        ref["previewSize"] = (previewWidth, previewHeight)
+    return ref
+
+def _packColour(colour):
+    colour = tuple(colour)
+    return (len(colour),) + colour + (0,) * (4 - len(colour))
+
+def _encodeText(s):
+    return s.encode("utf-8") if type(s) == unicode else s
+
+def _decodeText(data):
+    return str(data).decode("utf-8")
+
+FIELDS = {
+    "id": FixedField("d", lambda id: (id,), lambda t: t[0]),
+    "pos": FixedField("dd", lambda pos: (pos[0], pos[1]), lambda t: numpy.array(t)),
+    "rect": FixedField("iiii", lambda r: (r.left, r.top, r.width, r.height), lambda t: pygame.Rect(t)),
+    "colour": FixedField("5B", _packColour, lambda t: t[1:1+t[0]]), # number of components, RGBA
+    "isUserObject": FixedField("?", lambda b: (b,), lambda t: t[0]),
+    "lineWidth": FixedField("i", lambda w: (w,), lambda t: t[0]),
+    "fontSize": FixedField("i", lambda size: (size,), lambda t: t[0]),
+    "text": StringField(_encodeText, _decodeText),
+    "fontName": StringField(_encodeText, _decodeText),
+    "points": StringField(_pointsToString, lambda data: _pointsFromString(str(data))),
+    "image": ImageField(),
+}
+
+class ObjectSchema(object):
+    ''' the binary layout of the persistent members of a class of objects: the fixed-size members, packed with a single
+        struct, followed by the members of variable size, each prefixed with its length '''
+
+    def __init__(self, typeId, cls, members):
+        self.typeId = typeId
+        self.cls = cls
+        fields = [(name, FIELDS[name]) for name in members]
+        self.fixed = [(name, field) for name, field in fields if field.format is not None]
+        self.variable = [(name, field) for name, field in fields if field.format is None]
+        self.struct = struct.Struct("!" + "".join(field.format for name, field in self.fixed))
+        self.header = HEADER.pack(CODEC_VERSION, typeId)
+
+    def encode(self, obj):
+        values = []
+        for name, field in self.fixed:
+            values.extend(field.pack(field.get(obj, name)))
+        parts = [self.header, self.struct.pack(*values)]
+        for name, field in self.variable:
+            data = field.encode(field.get(obj, name))
+            parts.append(LENGTH.pack(len(data)))
+            parts.append(data)
+        return "".join(parts)
+
+    def decode(self, data):
+        ''' returns the dictionary of persistent members (as passed to the class's constructor) '''
+        values = self.struct.unpack_from(data, HEADER.size)
+        d = {}
+        i = 0
+        for name, field in self.fixed:
+            d[name] = field.unpack(values[i:i+field.count])
+            i += field.count
+        offset = HEADER.size + self.struct.size
+        for name, field in self.variable:
+            length = LENGTH.unpack_from(data, offset)[0]
+            offset += LENGTH.size
+            if offset + length > len(data):
+                raise ValueError("truncated object data")
+            d[name] = field.decode(buffer(data, offset, length))
+            offset += length
+        return d
+
+schemas = {} # class -> schema
+schemasById = {} # type id -> schema
+
+def register(schema):
+    schemas[schema.cls] = schema
+    schemasById[schema.typeId] = schema
+
+register(ObjectSchema(1, Rectangle, ["id", "pos", "rect", "colour"]))
+register(ObjectSchema(2, Image, ["id", "pos", "rect", "isUserObject", "image"]))
+register(ObjectSchema(3, Scribble, ["id", "pos", "rect", "isUserObject", "lineWidth", "colour", "image"]))
+register(ObjectSchema(4, PointBasedScribble, ["id", "pos", "isUserObject", "lineWidth", "colour", "points"]))
+register(ObjectSchema(5, Text, ["id", "pos", "rect", "isUserObject", "colour", "fontSize", "text", "fontName"]))
+
+def encodeObject(obj):
+    ''' returns the serialized form of the given object '''
+    schema = schemas.get(obj.__class__)
+    if schema is None:
+        raise ValueError("no schema for objects of class %s" % obj.__class__.__name__)
+    return schema.encode(obj)
+
+def decodeObject(s, legacy=False):
+    ''' returns the tuple (class, dictionary of persistent members) for the given serialized object;
+        legacy: whether to accept pickled dictionaries (see deserialize) '''
+    if len(s) >= HEADER.size:
+        version, typeId = HEADER.unpack_from(s)
+        if version == CODEC_VERSION:
+            schema = schemasById.get(typeId)
+            if schema is None:
+                raise ValueError("unknown object type %d" % typeId)
+            return schema.cls, schema.decode(s)
+    if not legacy:
+        raise ValueError("object is not schema-encoded")
+    d = pickle.loads(s)
+    return _objectClass(d["class"]), d
+
+def _objectClass(name):
+    ''' returns the class with the given qualified name (as stored in pickled dictionaries) '''
+    cls = globals().get(name.rsplit(".", 1)[-1])
+    if not (isinstance(cls, type) and issubclass(cls, BaseObject)):
+        raise ValueError("unknown object class %s" % name)
+    return cls
+
+def _parseNumber(s):
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+_legacyExpressions = [
+    (re.compile(r"pygame\.Rect\((-?\d+), (-?\d+), (-?\d+), (-?\d+)\)$"), lambda *args: pygame.Rect(*map(int, args))),
+    (re.compile(r"numpy\.array\(\[([^,\]]+), ([^,\]]+)\]\)$"), lambda x, y: numpy.array([_parseNumber(x), _parseNumber(y)])),
+]
+
+def _parseLegacyValue(expression):
+    ''' returns the value of an expression written by BaseObject._serializeValue '''
+    for pattern, construct in _legacyExpressions:
+        m = pattern.match(expression)
+        if m is not None:
+            return construct(*m.groups())
+    raise ValueError("unsupported expression in serialized object: %s" % expression)
+
 def boundingRect(objects):
     r = objects[0].absRect()
     return r.unionall([o.absRect() for o in objects[1:]])
+
+if __name__=='__main__':
+    # moving a freshly drawn stroke (integer position) by an offset as received from a peer
+    stroke = PointBasedScribble({"lineWidth": 3, "colour": (0, 0, 0)}, None, startPoint=(10, 20))
+    stroke.addPoints(pointArray([(30, 25), (45, 40)]))
+    stroke.endDrawing()
+    pos = tuple(stroke.pos)
+    offset = protocol.decode(protocol.encode(protocol.Opcode.MOVE_OBJECTS, 1, (2.5, -1.5), stroke.id))[-1][0]
+    stroke.offset(*offset)
+    assert tuple(stroke.pos) == (pos[0] + 2.5, pos[1] - 1.5)
+
+    # memory report: bytes per point of a list of coordinate tuples versus a point array
+    n = 1000000
+    points = [(1000 + i % 5000, 2000 + i % 3000) for i in xrange(n)]
+    tupleBytes = sys.getsizeof(points) + sum(sys.getsizeof(p) for p in points)
+    ints = set(c for p in points for c in p)
+    intBytes = sum(sys.getsizeof(c) for c in ints) # shared int objects, counted once
+    a = pointArray(points)
+    arrayBytes = sys.getsizeof(a)
+    print "points:               %d" % n
+    print "list of tuples:       %.1f bytes/point (%.1f including int objects)" % (float(tupleBytes) / n, float(tupleBytes + intBytes) / n)
+    print "point array:          %.1f bytes/point" % (float(arrayBytes) / n)
+    print "pickled list:         %.1f bytes/point" % (float(len(pickle.dumps(points, pickle.HIGHEST_PROTOCOL))) / n)
+    print "serialized array:     %.1f bytes/point" % (float(len(a.tostring())) / n)
+
+    # stroke growth: per-point drawing cost for long strokes extending in different directions
+    class Stroke(object):
+        lineWidth = 3
+        colour = (0, 0, 0)
+    numPoints = 5000
+    pointsPerFlush = 10
+    print
+    print "%10s %16s" % ("direction", "drawing [us/pt]")
+    for name, dx, dy in (("right", 1, 0), ("left", -1, 0), ("down", 0, 1), ("up", 0, -1), ("up-left", -1, -1)):
+        renderer = ScribbleRenderer(Stroke())
+        t = time.time()
+        for i in xrange(0, numPoints, pointsPerFlush):
+            renderer.addPoints([(j * dx, j * dy) for j in xrange(i, i + pointsPerFlush)])
+        print "%10s %16.2f" % (name, (time.time() - t) / numPoints * 1e6)
+
+    # board snapshots: serializing all objects for every joining client, with and without cached serializations
+    import os
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    numpy.random.seed(0)
+    board = []
+    for i in xrange(2000):
+        x, y = numpy.random.randint(0, 5000, 2)
+        points = pointArray(zip(x + numpy.arange(50), y + numpy.random.randint(0, 20, 50)))
+        board.append(PointBasedScribble({"points": points, "lineWidth": 3, "colour": (0, 0, 0)}, None))
+    for i in xrange(500):
+        board.append(Rectangle({"rect": pygame.Rect(i, i, 100, 50), "colour": (255, 0, 0)}, None))
+    numJoins = 10
+    print
+    print "objects:              %d" % len(board)
+    t = time.time()
+    for i in xrange(numJoins):
+        for o in board:
+            o._serialized = None # as before serializations were cached
+        serializedObjects = [o.serialize() for o in board]
+    print "uncached:             %.1f ms/join" % ((time.time() - t) / numJoins * 1e3)
+    t = time.time()
+    for i in xrange(numJoins):
+        serializedObjects = [o.serialize() for o in board]
+    print "cached:               %.1f ms/join" % ((time.time() - t) / numJoins * 1e3)
+    t = time.time()
+    packet = protocol.encode(protocol.Opcode.SET_OBJECTS, 1, serializedObjects)
+    print "compressed snapshot:  %d bytes (%d uncompressed), %.1f ms" % (len(packet), len(protocol._encodeStrings(serializedObjects)), (time.time() - t) * 1e3)
+
+    # object codec: encoding and decoding per object type, schemas versus pickled dictionaries with evaluated expressions
+    pygame.font.init()
+    image = pygame.Surface((200, 100))
+    image.fill((0, 128, 255))
+    scribble = Scribble({"lineWidth": 3, "colour": (0, 0, 0)}, None, startPoint=(100, 100))
+    scribble.addPoints([(110, 105), (130, 120), (160, 110)])
+    scribble.endDrawing()
+    samples = [board[-1], Image({"image": image, "rect": image.get_rect()}, None, isUserObject=True), scribble, board[0],
+        Text({"pos": (5, 5), "text": u"some text", "colour": (0, 0, 0), "fontName": "arial", "fontSize": 12}, None)]
+    n = 5000
+    print
+    print "%18s %10s %10s %12s %12s %13s %12s" % ("object", "pickle [B]", "schema [B]", "pickle [us]", "schema [us]", "unpickle [us]", "decode [us]")
+    for o in samples:
+        pickled = pickle.dumps(o.toDict())
+        encoded = encodeObject(o)
+        t = time.time()
+        for i in xrange(n):
+            pickle.dumps(o.toDict())
+        pickleTime = (time.time() - t) / n * 1e6
+        t = time.time()
+        for i in xrange(n):
+            encodeObject(o)
+        encodeTime = (time.time() - t) / n * 1e6
+        t = time.time()
+        for i in xrange(n): # as done by earlier versions
+            d = pickle.loads(pickled)
+            for name, value in d.iteritems():
+                if type(value) == str and value.startswith("_EVAL_:"):
+                    d[name] = eval(value[7:])
+        unpickleTime = (time.time() - t) / n * 1e6
+        t = time.time()
+        for i in xrange(n):
+            decodeObject(encoded)
+        decodeTime = (time.time() - t) / n * 1e6
+        print "%18s %10d %10d %12.1f %12.1f %13.1f %12.1f" % (o.__class__.__name__, len(pickled), len(encoded), pickleTime, encodeTime, unpickleTime, decodeTime)
@@ -0,0 +1,63 @@
+# (C) 2014 by Dominik Jain (djain@gmx.net)
+
+import collections
+import itertools
+
+class OperationLog(object):
+    ''' a log of the most recent sequence-numbered operations (encoded packets), from which the operations following a
+        given sequence number can be retrieved, provided that they have not yet been discarded; the oldest operations
+        are discarded once the log exceeds maxEntries operations or maxBytes bytes '''
+
+    def __init__(self, maxEntries=100000, maxBytes=32 * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = collections.deque() # (sequence number, packet)
+        self.numBytes = 0
+        self.lastSeq = 0 # sequence number of the most recent operation
+        self.firstSeq = 1 # sequence number of the oldest operation that has not been discarded
+
+    def append(self, seq, packet):
+        ''' adds the operation with the given sequence number, which must be lastSeq + 1 '''
+        if seq != self.lastSeq + 1:
+            raise ValueError("expected sequence number %d, got %d" % (self.lastSeq + 1, seq))
+        self.entries.append((seq, packet))
+        self.numBytes += len(packet)
+        self.lastSeq = seq
+        while len(self.entries) > self.maxEntries or (self.numBytes > self.maxBytes and len(self.entries) > 1):
+            self.numBytes -= len(self.entries.popleft()[1])
+        self.firstSeq = self.entries[0][0]
+
+    def since(self, seq):
+        ''' returns the packets of the operations following the one with the given sequence number or None if
+            some of them have been discarded (or the sequence number is unknown) '''
+        if seq > self.lastSeq or seq + 1 < self.firstSeq:
+            return None
+        # sequence numbers are consecutive, so the operations to return are the last lastSeq - seq entries
+        packets = [e[1] for e in itertools.islice(reversed(self.entries), self.lastSeq - seq)]
+        packets.reverse()
+        return packets
+
+if __name__=='__main__':
+    # benchmark: data sent to a reconnecting client, a full snapshot compared to the operations it missed
+    import os
+    import time
+    import protocol
+    from protocol import Opcode
+
+    numObjects = 5000
+    objects = [os.urandom(600) for i in xrange(numObjects)] # serialized objects of a typical size
+    log = OperationLog()
+    for i in xrange(200000): # a long session of strokes
+        seq = log.lastSeq + 1
+        log.append(seq, protocol.sequence(protocol.encode(Opcode.ADD_POINTS, 1, float(i), range(20)), seq))
+    t = time.time()
+    snapshot = protocol.encode(Opcode.SET_OBJECTS, 1, objects)
+    snapshotTime = time.time() - t
+    print "operations logged: %d (%d retained, %d bytes)" % (log.lastSeq, len(log.entries), log.numBytes)
+    print "%16s %14s %12s" % ("missed ops", "sent [bytes]", "time [ms]")
+    print "%16s %14d %12.2f" % ("snapshot", len(snapshot), snapshotTime * 1e3)
+    for missed in (10, 1000, 50000):
+        t = time.time()
+        packets = log.since(log.lastSeq - missed)
+        print "%16d %14d %12.2f" % (missed, sum(len(p) for p in packets), (time.time() - t) * 1e3)
+    print "%16s %14s" % ("truncated", "snapshot" if log.since(1) is None else "ops")
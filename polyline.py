@@ -0,0 +1,120 @@
+# (C) 2014 by Dominik Jain (djain@gmx.net)
+
+import numpy
+import pygame
+import pygame.surfarray
+
+_discs = {} # line width -> (x offsets, y offsets) of the pixels covered by a disc of that diameter
+
+MAX_SEGMENT_POINTS = 32 # polylines with at most this many points are drawn segment by segment (see drawPolyline)
+
+def _disc(lineWidth):
+    disc = _discs.get(lineWidth)
+    if disc is None:
+        r = lineWidth / 2.0
+        ri = int(r)
+        dx, dy = numpy.mgrid[-ri:ri+1, -ri:ri+1]
+        mask = dx*dx + dy*dy <= r*r
+        disc = _discs[lineWidth] = (dx[mask], dy[mask])
+    return disc
+
+def samplePolyline(points, step):
+    ''' returns an (n, 2) array of positions along the polyline given by the (m, 2) array points,
+        with consecutive positions on each segment at most step apart '''
+    if len(points) < 2:
+        return points
+    d = points[1:] - points[:-1]
+    lengths = numpy.sqrt((d*d).sum(axis=1))
+    counts = numpy.maximum(1, numpy.ceil(lengths / step)).astype(int)
+    segment = numpy.repeat(numpy.arange(len(d)), counts)
+    first = numpy.cumsum(counts) - counts # index of each segment's first sample
+    t = (numpy.arange(counts.sum()) - first[segment]) / counts[segment].astype(float)
+    samples = points[segment] + d[segment] * t[:, None]
+    return numpy.vstack((samples, points[-1:]))
+
+def _dropRepeated(points):
+    ''' removes consecutive duplicates from an (n, 2) array of points '''
+    if len(points) < 2:
+        return points
+    keep = numpy.ones(len(points), dtype=bool)
+    keep[1:] = (points[1:] != points[:-1]).any(axis=1)
+    return points[keep]
+
+def simplify(points, tolerance):
+    ''' simplifies the polyline given by the (n, 2) array points by snapping the points to a grid with the given cell size
+        and dropping consecutive duplicates; for strokes rendered at a low zoom factor, this removes all the detail
+        that would not be visible anyway '''
+    return _dropRepeated(numpy.rint(numpy.asarray(points, dtype=float) / tolerance) * tolerance)
+
+def _drawSegments(surface, colour, points, lineWidth):
+    ''' draws the polyline given by the (n, 2) array points with pygame's line drawing, stamping a circle at every point
+        for round joins and caps '''
+    points = numpy.rint(points).astype(int).tolist()
+    if len(points) == 1:
+        points = points * 2
+    pygame.draw.lines(surface, colour, False, points, lineWidth)
+    if lineWidth > 2:
+        for p in points:
+            pygame.draw.circle(surface, colour, p, lineWidth // 2)
+
+def drawPolyline(surface, colour, points, lineWidth, origin=(0, 0), startPoint=None):
+    ''' draws a thick polyline with round joins and caps in a single vectorized pass by stamping discs along it.
+        points is a flat sequence of coordinates x0, y0, x1, y1, ... (e.g. a point array) or an (n, 2) array;
+        the polyline starts at startPoint (if given) and points are translated by -origin.
+        Short polylines (such as the few points of a stroke flushed while drawing) are drawn segment by segment instead,
+        as the fixed cost of the vectorized pass outweighs its per-point savings for up to MAX_SEGMENT_POINTS points.
+        The surface must not be locked and must have 8, 16 or 32 bits per pixel '''
+    points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+    if startPoint is not None:
+        points = numpy.vstack((numpy.asarray(startPoint, dtype=float).reshape(1, 2), points))
+    if len(points) == 0:
+        return
+    points = points - numpy.asarray(origin, dtype=float)
+    if len(points) <= MAX_SEGMENT_POINTS:
+        _drawSegments(surface, colour, points, lineWidth)
+        return
+    discX, discY = _disc(lineWidth)
+    # with discs stamped at most half a line width apart, the outline deviates from the exact one by less than lineWidth/16
+    samples = _dropRepeated(numpy.rint(samplePolyline(points, max(1.0, lineWidth / 2.0))).astype(int))
+    xs = (samples[:, 0:1] + discX).ravel()
+    ys = (samples[:, 1:2] + discY).ravel()
+    width, height = surface.get_size()
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    pixels = pygame.surfarray.pixels2d(surface)
+    pixels[xs[inside], ys[inside]] = surface.map_rgb(colour)
+    del pixels # unlocks the surface
+
+if __name__=='__main__':
+    # benchmark: drawPolyline (vectorized beyond MAX_SEGMENT_POINTS points) compared to drawing each segment individually
+    import time
+    import aaline
+
+    def drawSegments(surface, colour, points, lineWidth):
+        lineStartPos = numpy.array(points[0])
+        for p in points:
+            pos = numpy.array(p)
+            pygame.draw.line(surface, colour, lineStartPos, pos, lineWidth)
+            lineStartPos = pos
+
+    def drawSegmentsAA(surface, colour, points, lineWidth):
+        for i in xrange(len(points) - 1):
+            aaline.aaline(surface, colour, points[i], points[i+1], lineWidth)
+
+    numpy.random.seed(0)
+    lineWidth = 3
+    colour = (0, 0, 0)
+    print "%8s %18s %18s %18s" % ("points", "per segment [ms]", "aaline [ms]", "drawPolyline [ms]")
+    for n in (10, 100, 1000, 100000):
+        steps = numpy.random.randint(-3, 4, size=(n, 2))
+        steps[:, 0] += 1 # drift to the right, as in handwriting
+        a = numpy.cumsum(steps, axis=0)
+        a -= a.min(axis=0) - lineWidth
+        size = tuple(a.max(axis=0) + lineWidth + 1)
+        points = [tuple(p) for p in a]
+        times = []
+        for draw in (drawSegments, drawSegmentsAA, lambda s, c, p, w: drawPolyline(s, c, a, w)):
+            surface = pygame.Surface(size, depth=32)
+            t = time.time()
+            draw(surface, colour, points, lineWidth)
+            times.append((time.time() - t) * 1e3)
+        print "%8d %18.2f %18.2f %18.2f" % ((n,) + tuple(times))
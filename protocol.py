@@ -0,0 +1,214 @@
+# (C) 2014 by Dominik Jain (djain@gmx.net)
+
+import struct
+import array
+import zlib
+
+VERSION = 2
+
+# every packet starts with an envelope: protocol version, opcode, sender id, sequence number (assigned by the server
+# to the operations it distributes, see SEQUENCED_OPCODES; 0 for all other packets)
+ENVELOPE = struct.Struct("!BBII")
+SEQ = struct.Struct("!I")
+SEQ_OFFSET = ENVELOPE.size - SEQ.size
+
+ID = struct.Struct("!d")
+VEC2 = struct.Struct("!dd")
+LENGTH = struct.Struct("!I")
+
+OBJECT_CODEC_VERSION = 1 # the first byte of every serialized object (see objects.encodeObject)
+
+class ProtocolError(Exception):
+    pass
+
+class Opcode(object):
+    PING, ADD_USER, MOVE_USER_CURSOR, ADD_OBJECT, DELETE_OBJECTS, MOVE_OBJECTS, SET_OBJECTS, ADD_POINTS, END_DRAWING, SET_TEXT, PONG, BLOB_WANT, BLOB_PUT, JOIN, SESSION, ACK = range(16)
+
+# the opcodes of operations that change the board, which the server sequences and logs, such that a client that
+# reconnects can catch up on the operations it missed
+SEQUENCED_OPCODES = frozenset((Opcode.ADD_OBJECT, Opcode.DELETE_OBJECTS, Opcode.MOVE_OBJECTS, Opcode.SET_OBJECTS,
+    Opcode.ADD_POINTS, Opcode.END_DRAWING, Opcode.SET_TEXT))
+
+# maps names of object operations (as passed to Whiteboard.onObjectUpdated) to opcodes and vice versa
+UPDATE_OPCODES = {"addPoints": Opcode.ADD_POINTS, "endDrawing": Opcode.END_DRAWING, "setText": Opcode.SET_TEXT}
+UPDATE_OPERATIONS = dict((opcode, name) for name, opcode in UPDATE_OPCODES.iteritems())
+
+_codecs = {} # opcode -> (encode function, decode function)
+
+def register(opcode, encode, decode):
+    ''' registers the payload codec for an opcode: encode maps the arguments to a string, decode maps a buffer back to the tuple of arguments '''
+    _codecs[opcode] = (encode, decode)
+
+def encode(opcode, sender, *args):
+    return ENVELOPE.pack(VERSION, opcode, sender, 0) + _codecs[opcode][0](*args)
+
+def sequence(packet, seq):
+    ''' returns a copy of the given packet with the given sequence number '''
+    return packet[:SEQ_OFFSET] + SEQ.pack(seq) + packet[ENVELOPE.size:]
+
+def decode(packet):
+    ''' returns the tuple (opcode, sender, sequence number, args) for the given packet '''
+    if len(packet) < ENVELOPE.size:
+        raise ProtocolError("packet too short")
+    version, opcode, sender, seq = ENVELOPE.unpack_from(packet)
+    if version != VERSION:
+        raise ProtocolError("unsupported protocol version %d" % version)
+    codec = _codecs.get(opcode)
+    if codec is None:
+        raise ProtocolError("unknown opcode %d" % opcode)
+    return opcode, sender, seq, codec[1](buffer(packet, ENVELOPE.size))
+
+def _encodeIds(ids):
+    return struct.pack("!%dd" % len(ids), *ids)
+
+def _decodeIds(payload, offset=0):
+    return struct.unpack_from("!%dd" % ((len(payload) - offset) / ID.size), payload, offset)
+
+def _encodeString(s):
+    return s.encode("utf-8") if type(s) == unicode else s
+
+def _decodeString(payload):
+    return str(payload).decode("utf-8")
+
+def _encodeStrings(strings):
+    return LENGTH.pack(len(strings)) + "".join(LENGTH.pack(len(s)) + s for s in strings)
+
+def _decodeStrings(payload):
+    count = LENGTH.unpack_from(payload)[0]
+    offset = LENGTH.size
+    strings = []
+    for i in xrange(count):
+        length = LENGTH.unpack_from(payload, offset)[0]
+        offset += LENGTH.size
+        strings.append(str(payload[offset:offset+length]))
+        offset += length
+    return strings
+
+def _encodeCompressedStrings(strings):
+    ''' encodes a list of strings compressed with zlib (for snapshots of the board, whose serialized objects have much in common) '''
+    return zlib.compress(_encodeStrings(strings), 1)
+
+def _decodeCompressedStrings(payload):
+    try:
+        return _decodeStrings(zlib.decompress(payload))
+    except zlib.error, e:
+        raise ProtocolError("invalid compressed payload: %s" % e)
+
+def _encodeVarint(n, out):
+    ''' appends the zigzag-encoded signed integer n to the bytearray out (7 bits per byte, least significant first) '''
+    n = (n << 1) if n >= 0 else ((-n << 1) - 1)
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _decodeVarints(payload, offset=0):
+    values = []
+    data = bytearray(payload[offset:])
+    n = shift = 0
+    for b in data:
+        n |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            values.append((n >> 1) if not (n & 1) else -((n + 1) >> 1))
+            n = shift = 0
+    return values
+
+def _encodePoints(points):
+    ''' encodes a run of points, given as a flat sequence of integer coordinates x0, y0, x1, y1, ...,
+        the first point absolute, all others as deltas to their predecessor '''
+    out = bytearray()
+    prevX = prevY = 0
+    for i in xrange(0, len(points) - 1, 2):
+        x, y = int(points[i]), int(points[i+1])
+        _encodeVarint(x - prevX, out)
+        _encodeVarint(y - prevY, out)
+        prevX, prevY = x, y
+    return str(out)
+
+def _decodePoints(payload, offset=0):
+    ''' decodes a run of points to a flat array of integer coordinates '''
+    values = _decodeVarints(payload, offset)
+    points = array.array("i")
+    x = y = 0
+    for i in xrange(0, len(values) - 1, 2):
+        x += values[i]
+        y += values[i+1]
+        points.append(x)
+        points.append(y)
+    return points
+
+register(Opcode.PING, lambda time: ID.pack(time), lambda p: ID.unpack_from(p))
+register(Opcode.PONG, lambda time: ID.pack(time), lambda p: ID.unpack_from(p))
+register(Opcode.ADD_USER, _encodeString, lambda p: (_decodeString(p),))
+register(Opcode.MOVE_USER_CURSOR, lambda pos: VEC2.pack(pos[0], pos[1]), lambda p: (VEC2.unpack_from(p),))
+def _checkObject(s):
+    ''' raises ProtocolError unless the given serialized object is schema-encoded (objects are never unpickled from the network) '''
+    if len(s) == 0 or ord(s[0]) != OBJECT_CODEC_VERSION:
+        raise ProtocolError("object is not schema-encoded")
+    return s
+
+def _decodeObjects(payload):
+    return map(_checkObject, _decodeCompressedStrings(payload))
+
+register(Opcode.ADD_OBJECT, lambda s: s, lambda p: (_checkObject(str(p)),))
+register(Opcode.DELETE_OBJECTS, lambda *ids: _encodeIds(ids), _decodeIds)
+register(Opcode.MOVE_OBJECTS, lambda offset, *ids: VEC2.pack(offset[0], offset[1]) + _encodeIds(ids),
+    lambda p: (VEC2.unpack_from(p),) + _decodeIds(p, VEC2.size))
+register(Opcode.SET_OBJECTS, _encodeCompressedStrings, lambda p: (_decodeObjects(p),))
+register(Opcode.ADD_POINTS, lambda objectId, points: ID.pack(objectId) + _encodePoints(points),
+    lambda p: (ID.unpack_from(p)[0], _decodePoints(p, ID.size)))
+register(Opcode.END_DRAWING, lambda objectId: ID.pack(objectId), lambda p: ID.unpack_from(p))
+register(Opcode.SET_TEXT, lambda objectId, text: ID.pack(objectId) + _encodeString(text),
+    lambda p: (ID.unpack_from(p)[0], _decodeString(p[ID.size:])))
+register(Opcode.BLOB_WANT, lambda *keys: _encodeStrings(keys), lambda p: tuple(_decodeStrings(p)))
+register(Opcode.BLOB_PUT, lambda key, data: _encodeStrings((key, data)), lambda p: tuple(_decodeStrings(p)))
+register(Opcode.JOIN, lambda sessionId, lastSeq: struct.pack("!II", sessionId, lastSeq), lambda p: struct.unpack_from("!II", p))
+register(Opcode.SESSION, lambda sessionId: struct.pack("!I", sessionId), lambda p: struct.unpack_from("!I", p))
+register(Opcode.ACK, lambda count: struct.pack("!I", count), lambda p: struct.unpack_from("!I", p)) # number of operations received from the client
+
+if __name__=='__main__':
+    # benchmark: per-message decode and dispatch cost compared to pickled dicts with exec/eval
+    import pickle
+    import time
+
+    class Target(object):
+        def __init__(self):
+            self.handlers = {
+                Opcode.MOVE_USER_CURSOR: lambda sender, pos: self.moveUserCursor("user", pos),
+                Opcode.ADD_POINTS: lambda sender, objectId, points: self.updateObject(objectId, UPDATE_OPERATIONS[Opcode.ADD_POINTS], (points,))
+            }
+        def moveUserCursor(self, userName, pos):
+            pass
+        def updateObject(self, objectId, operation, args):
+            obj = self
+            getattr(obj, operation)(*args)
+        def evalUpdateObject(self, objectId, operation, args):
+            obj = self
+            eval("obj.%s(*args)" % operation)
+        def addPoints(self, points):
+            pass
+
+    target = Target()
+    n = 20000
+    points = array.array("i", [100 + i // 2 for i in range(20)])
+    messages = [
+        ("moveUserCursor", dict(evt="moveUserCursor", args=("user", (123.0, 456.0))), encode(Opcode.MOVE_USER_CURSOR, 1, (123.0, 456.0))),
+        ("addPoints (10)", dict(evt="evalUpdateObject", args=(12345.678, "addPoints", (points,))), encode(Opcode.ADD_POINTS, 1, 12345.678, points)),
+    ]
+    print "%16s %12s %12s %14s %14s" % ("message", "pickle [B]", "binary [B]", "exec [us/msg]", "table [us/msg]")
+    for name, d, packet in messages:
+        data = pickle.dumps(d)
+        self = target
+        t = time.time()
+        for i in xrange(n):
+            d = pickle.loads(data)
+            exec("self.%s(*d['args'])" % d["evt"])
+        execTime = (time.time() - t) / n * 1e6
+        t = time.time()
+        for i in xrange(n):
+            opcode, sender, seq, args = decode(packet)
+            target.handlers[opcode](sender, *args)
+        tableTime = (time.time() - t) / n * 1e6
+        print "%16s %12d %12d %14.2f %14.2f" % (name, len(data), len(packet), execTime, tableTime)
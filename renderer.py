@@ -1,17 +1,40 @@
 # (C) 2014 by Dominik Jain (djain@gmx.net)
 
 import os
+import math
+import threading
+import time
 import pygame
 from pygame import sprite
+import spatial
+import tiles
 
 class WhiteboardRenderer(sprite.LayeredUpdates):
     def __init__(self, game):
-        sprite.LayeredUpdates.__init__(self)
-        
         self.game = game
         
+        sprite.LayeredUpdates.__init__(self)
+        
         self.userObjects = sprite.Group()
         self.uiObjects = sprite.Group()
+        self.userObjectIndex = spatial.SpatialGrid()
+        self.visibleObjects = []
+        self.drawOrderCounter = 0
+        self.trackDamage = True # if False, the entire screen is redrawn in every frame
+        self.drawnObjects = {} # object -> (screen rect, image) as of the last frame, where the image is scaled to the camera's zoom
+        self.changedObjects = set()
+        self.changeLock = threading.Lock() # guards changedObjects and removedObjects, which other threads (e.g. the network thread) add to
+        self.damage = []
+        self.fullRedraw = True
+        self.lastCameraState = None
+        # user objects are either committed, i.e. rendered into the tile cache, or live, i.e. drawn individually on top of the tiles;
+        # changed objects are live until they have not changed for liveDuration seconds
+        self.backgroundColour = (255, 255, 255)
+        self.tileCache = tiles.TileCache(self._drawCommittedObjects)
+        self.committedObjects = {} # object -> absolute rect as rendered into the tiles
+        self.liveObjects = {} # object -> time of last change
+        self.liveDuration = 1.0
+        self.removedObjects = set()
         
         #sprite.LayeredUpdates.add(self, self.userObjects, self.uiObjects)
         
@@ -20,19 +43,172 @@ class WhiteboardRenderer(sprite.LayeredUpdates):
     def add(self, *objects):
         sprite.LayeredUpdates.add(self, *objects)
         for object in objects:
+            object.drawOrder = self.drawOrderCounter
+            self.drawOrderCounter += 1
             if object.isUserObject:
                 self.userObjects.add(object)
+                object.renderer = self
+                self.userObjectIndex.insert(object)
+                with self.changeLock:
+                    self.changedObjects.add(object)
             else:
                 self.uiObjects.add(object)
+        self.game.wakeUp()
+
+    def remove_internal(self, object):
+        sprite.LayeredUpdates.remove_internal(self, object)
+        if object.renderer is self:
+            object.renderer = None
+            self.userObjectIndex.remove(object)
+            with self.changeLock:
+                self.removedObjects.add(object)
+        self.game.wakeUp()
+
+    def objectChanged(self, object):
+        self.userObjectIndex.update(object)
+        with self.changeLock:
+            self.changedObjects.add(object)
+        self.game.wakeUp()
+
+    def userObjectsAt(self, x, y):
+        ''' returns the user objects whose absolute extents contain the given point '''
+        return self.userObjectIndex.queryPoint(x, y)
+
+    def userObjectsIn(self, rect):
+        ''' returns the user objects whose absolute extents intersect the given rectangle '''
+        return self.userObjectIndex.queryRect(rect)
     
     def setBackgroundSize(self, size):
         self.background = pygame.Surface(self.game.screen.get_size())
-        self.background.fill((255,255,255))
+        self.background.fill(self.backgroundColour)
         self.game.screen.blit(self.background, [0,0])    
+        self.fullRedraw = True
     
+    def viewport(self):
+        ''' returns the rectangle (in absolute coordinates) that is currently visible on screen '''
+        return self.game.camera.screenRectToWorld(pygame.Rect(0, 0, self.game.width, self.game.height))
+
+    def _drawCommittedObjects(self, surface, rect, scale):
+        surface.fill(self.backgroundColour)
+        objects = [o for o in self.userObjectsIn(rect) if o in self.committedObjects]
+        objects.sort(key=lambda o: o.drawOrder)
+        for o in objects:
+            r = self.committedObjects[o]
+            # rounded down, such that an object spanning several tiles is placed consistently in all of them
+            surface.blit(o.lodImage(scale), (int(math.floor((r.x - rect.x) * scale)), int(math.floor((r.y - rect.y) * scale))))
+
+    def _updateLiveObjects(self, changedObjects, damage):
+        ''' makes changed objects live and commits objects that have not changed recently to the tile cache,
+            adding the absolute rectangles that need to be redrawn to damage '''
+        with self.changeLock:
+            removedObjects, self.removedObjects = self.removedObjects, set()
+        for o in removedObjects:
+            self.liveObjects.pop(o, None)
+            rect = self.committedObjects.pop(o, None)
+            if rect is not None:
+                self.tileCache.invalidate(rect)
+                damage.append(rect)
+        now = time.time()
+        for o in changedObjects:
+            if o.renderer is not self:
+                continue
+            rect = self.committedObjects.pop(o, None)
+            if rect is not None:
+                self.tileCache.invalidate(rect)
+                damage.append(rect)
+            self.liveObjects[o] = now
+        for o, t in self.liveObjects.items():
+            if now - t >= self.liveDuration:
+                del self.liveObjects[o]
+                rect = o.absRect()
+                self.committedObjects[o] = rect
+                self.tileCache.invalidate(rect)
+
+    def _overlayObjects(self, viewport):
+        ''' returns the user objects within the viewport that must be drawn on top of the tiles, i.e. the live objects
+            and the committed objects that are (transitively) above an overlapping live object '''
+        objects = set(o for o in self.liveObjects if o.absRect().colliderect(viewport))
+        pending = list(objects)
+        while pending:
+            o = pending.pop()
+            for c in self.userObjectsIn(o.absRect()):
+                if c.drawOrder > o.drawOrder and c not in objects and c in self.committedObjects:
+                    objects.add(c)
+                    pending.append(c)
+        return list(objects)
+
+    def update(self, game):
+        ''' updates the objects that are drawn individually, i.e. all UI objects and the live user objects within the viewport,
+            and determines the screen regions that need to be redrawn '''
+        camera = game.camera
+        with self.changeLock:
+            changedObjects, self.changedObjects = self.changedObjects, set()
+        absDamage = []
+        self._updateLiveObjects(changedObjects, absDamage)
+        self.tileCache.setScale(camera.zoom)
+
+        objects = self._overlayObjects(self.viewport())
+        objects.extend(self.uiObjects.sprites())
+        objects.sort(key=lambda o: (self.get_layer_of_sprite(o), o.drawOrder))
+        for o in objects:
+            o.update(game)
+        self.visibleObjects = objects
+
+        cameraState = (tuple(camera.pos), camera.zoom)
+        if cameraState != self.lastCameraState:
+            self.lastCameraState = cameraState
+            self.fullRedraw = True
+        drawnObjects = {}
+        for o in objects:
+            if o.scaleWithZoom and camera.zoom != 1:
+                image = o.lodImage(camera.zoom)
+                drawnObjects[o] = (pygame.Rect(o.rect.topleft, image.get_size()), image)
+            else:
+                drawnObjects[o] = (o.rect.copy(), o.image)
+        if self.trackDamage and not self.fullRedraw:
+            damage = self.damage
+            for r in absDamage:
+                damage.append(camera.worldRectToScreen(r))
+            for o, (rect, image) in drawnObjects.iteritems():
+                prev = self.drawnObjects.get(o)
+                if prev is None:
+                    damage.append(rect)
+                elif prev[1] is not image or prev[0] != rect or o in changedObjects:
+                    damage.append(prev[0])
+                    damage.append(rect)
+            for o, (rect, image) in self.drawnObjects.iteritems():
+                if o not in drawnObjects: # object was killed, left the viewport or was committed
+                    damage.append(rect)
+        self.drawnObjects = drawnObjects
+
     def draw(self):
-        self.clear(self.game.screen, self.background)
-        things = sprite.LayeredUpdates.draw(self, self.game.screen)
-        pygame.display.update(things)
-        pygame.display.flip()
-    
\ No newline at end of file
+        screen = self.game.screen
+        camera = self.game.camera
+        if not self.trackDamage or self.fullRedraw:
+            self.fullRedraw = False
+            self.damage = []
+            self.tileCache.blit(screen, self.viewport(), camera.pos)
+            for o in self.visibleObjects:
+                rect, image = self.drawnObjects[o]
+                screen.blit(image, rect)
+            pygame.display.flip()
+            return
+
+        damage, self.damage = self.damage, []
+        screenRect = screen.get_rect()
+        damage = [r.clip(screenRect) for r in damage]
+        damage = [r for r in damage if r.width > 0 and r.height > 0]
+        if len(damage) == 0:
+            return
+        if len(damage) > 16: # recompositing a single region is cheaper than processing many small ones
+            damage = [damage[0].unionall(damage[1:])]
+
+        for r in damage:
+            screen.set_clip(r)
+            self.tileCache.blit(screen, camera.screenRectToWorld(r), camera.pos)
+            for o in self.visibleObjects:
+                rect, image = self.drawnObjects[o]
+                if rect.colliderect(r):
+                    screen.blit(image, rect)
+        screen.set_clip(None)
+        pygame.display.update(damage)
@@ -0,0 +1,136 @@
+# (C) 2014 by Dominik Jain (djain@gmx.net)
+
+import threading
+import pygame
+
+class SpatialGrid(object):
+    ''' a uniform grid over absolute object extents, which supports sublinear point and rectangle queries '''
+
+    def __init__(self, cellSize=256):
+        self.cellSize = cellSize
+        self.cells = {}
+        self.extents = {} # object -> (rect, (cx1, cy1, cx2, cy2))
+        self.lock = threading.RLock()
+
+    def _cellRange(self, rect):
+        cs = self.cellSize
+        return (int(rect.left) // cs, int(rect.top) // cs, int(rect.right) // cs, int(rect.bottom) // cs)
+
+    def insert(self, obj, rect=None):
+        ''' adds the given object (or updates its extents if it is already present) '''
+        if rect is None:
+            rect = obj.absRect()
+        with self.lock:
+            if obj in self.extents:
+                self.remove(obj)
+            cr = self._cellRange(rect)
+            cx1, cy1, cx2, cy2 = cr
+            for cx in xrange(cx1, cx2+1):
+                for cy in xrange(cy1, cy2+1):
+                    cell = self.cells.get((cx, cy))
+                    if cell is None:
+                        cell = self.cells[(cx, cy)] = set()
+                    cell.add(obj)
+            self.extents[obj] = (rect, cr)
+
+    update = insert
+
+    def remove(self, obj):
+        with self.lock:
+            entry = self.extents.pop(obj, None)
+            if entry is None:
+                return
+            cx1, cy1, cx2, cy2 = entry[1]
+            for cx in xrange(cx1, cx2+1):
+                for cy in xrange(cy1, cy2+1):
+                    cell = self.cells.get((cx, cy))
+                    if cell is not None:
+                        cell.discard(obj)
+                        if len(cell) == 0:
+                            del self.cells[(cx, cy)]
+
+    def clear(self):
+        with self.lock:
+            self.cells = {}
+            self.extents = {}
+
+    def __contains__(self, obj):
+        return obj in self.extents
+
+    def __len__(self):
+        return len(self.extents)
+
+    def rectOf(self, obj):
+        entry = self.extents.get(obj)
+        return None if entry is None else entry[0]
+
+    def queryPoint(self, x, y):
+        ''' returns the list of objects whose extents contain the given point '''
+        cs = self.cellSize
+        with self.lock:
+            cell = self.cells.get((int(x) // cs, int(y) // cs))
+            if cell is None:
+                return []
+            return [o for o in cell if self.extents[o][0].collidepoint(x, y)]
+
+    def queryRect(self, rect):
+        ''' returns the list of objects whose extents intersect the given rectangle '''
+        rect = pygame.Rect(rect)
+        rect.normalize()
+        with self.lock:
+            cx1, cy1, cx2, cy2 = self._cellRange(rect)
+            numCells = (cx2 - cx1 + 1) * (cy2 - cy1 + 1)
+            if numCells > len(self.cells):
+                # the query area covers more cells than there are occupied cells
+                candidates = set()
+                for (cx, cy), cell in self.cells.iteritems():
+                    if cx1 <= cx <= cx2 and cy1 <= cy <= cy2:
+                        candidates.update(cell)
+            else:
+                candidates = set()
+                for cx in xrange(cx1, cx2+1):
+                    for cy in xrange(cy1, cy2+1):
+                        cell = self.cells.get((cx, cy))
+                        if cell is not None:
+                            candidates.update(cell)
+            return [o for o in candidates if self.extents[o][0].colliderect(rect)]
+
+if __name__=='__main__':
+    import random
+    import time
+
+    class Obj(object):
+        def __init__(self, rect):
+            self.rect = rect
+        def absRect(self):
+            return self.rect
+
+    random.seed(0)
+    numQueries = 1000
+    print "%8s %16s %16s %16s %16s" % ("objects", "linear pt [us]", "grid pt [us]", "linear rect [us]", "grid rect [us]")
+    for n in (1000, 10000, 50000, 100000):
+        extent = int((n * 40000) ** 0.5) # keep density constant
+        objs = [Obj(pygame.Rect(random.randint(0, extent), random.randint(0, extent), random.randint(5, 200), random.randint(5, 200))) for i in xrange(n)]
+        grid = SpatialGrid()
+        for o in objs:
+            grid.insert(o)
+        points = [(random.randint(0, extent), random.randint(0, extent)) for i in xrange(numQueries)]
+        rects = [pygame.Rect(x, y, 800, 600) for x, y in points]
+
+        t = time.time()
+        for x, y in points:
+            filter(lambda o: o.rect.collidepoint((x, y)), objs)
+        linearPt = (time.time() - t) / numQueries * 1e6
+        t = time.time()
+        for x, y in points:
+            grid.queryPoint(x, y)
+        gridPt = (time.time() - t) / numQueries * 1e6
+        t = time.time()
+        for r in rects[:100]:
+            filter(lambda o: o.rect.colliderect(r), objs)
+        linearRect = (time.time() - t) / 100 * 1e6
+        t = time.time()
+        for r in rects[:100]:
+            grid.queryRect(r)
+        gridRect = (time.time() - t) / 100 * 1e6
+        print "%8d %16.1f %16.1f %16.1f %16.1f" % (n, linearPt, gridPt, linearRect, gridRect)
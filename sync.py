@@ -1,16 +1,20 @@
 # (C) 2014 by Dominik Jain (djain@gmx.net)
 
 import sys
-import pickle
 import wx
+import random
 import time as t
 import traceback
+import threading
 from whiteboard import Whiteboard
 import objects
 import numpy
 import time
 import logging
 from net import *
+import protocol
+from protocol import Opcode
+from oplog import OperationLog
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -21,34 +25,83 @@ class DispatchingWhiteboard(Whiteboard):
 		self.lastPing = t.time()
 		self.lastCursorMoveTime = t.time()
 		self.userName = "user " + str(t.time())
+		self.senderId = random.getrandbits(32)
 		self.remoteUserCursorUpdateInterval = 0.1
+		self.rtt = None # smoothed round trip time in seconds
+		self.maxStrokeFlushInterval = 0.25
+		# server: the log of sequenced operations, which allows clients to resume after reconnecting
+		self.sessionId = random.randint(1, 2**32 - 1) if isServer else None
+		self.opLog = OperationLog()
+		self.sequenceLock = threading.Lock() # held while sequencing and sending an operation
+		self.snapshot = None # (sequence number, SET_OBJECTS packet) of the most recent snapshot sent to a joining client
+		self.maxSnapshotCatchUpRatio = 0.25 # a snapshot is reused if the operations following it take up at most this fraction of its size
+		self.opsReceived = {} # connection id -> number of operations received from the connection (acknowledged to the client)
+		# client: the session joined and the sequence number of the last operation received (None if a resume is not possible)
+		self.connected = False
+		self.joined = False
+		self.lastSeq = None
+		self.resuming = False # whether the operations received are those missed while disconnected (rather than following a snapshot)
+		self.opsSent = 0 # number of operations sent via the current connection
+		self.opsAcknowledged = 0 # number of operations the server has acknowledged receiving via the current connection
 		Whiteboard.__init__(self, title, **kwargs)
 		self.Centre()
+		self.pingTimer = wx.Timer(self)
+		self.Bind(wx.EVT_TIMER, self.OnTimer, self.pingTimer)
+		self.pingTimer.Start(1000)
 		self.connId2UserName = {}
+		self.senderId2UserName = {}
+		self.networkHandlers = {
+			Opcode.ADD_USER: self.handleAddUser,
+			Opcode.MOVE_USER_CURSOR: lambda sender, pos: self.moveUserCursor(self.senderId2UserName.get(sender), pos),
+			Opcode.ADD_OBJECT: lambda sender, s: self.addObject(s),
+			Opcode.DELETE_OBJECTS: lambda sender, *ids: self.deleteObjects(*ids),
+			Opcode.MOVE_OBJECTS: lambda sender, offset, *ids: self.moveObjects(offset, *ids),
+			Opcode.SET_OBJECTS: lambda sender, objects: self.setObjects(objects, False),
+		}
+		for opcode, operation in protocol.UPDATE_OPERATIONS.iteritems():
+			self.networkHandlers[opcode] = self._updateObjectHandler(operation)
+		objects.imageBlobs.onMissing = self.onBlobMissing
 	
+	def _updateObjectHandler(self, operation):
+		return lambda sender, objectId, *args: self.updateObject(objectId, operation, args)
+
 	def onObjectCreationCompleted(self, object):
-		self.dispatch(evt="addObject", args=(object.serialize(),))
+		self.dispatch(Opcode.ADD_OBJECT, object.serialize())
 
 	def onObjectsDeleted(self, *ids):
-		self.dispatch(evt="deleteObjects", args=ids)
+		self.dispatch(Opcode.DELETE_OBJECTS, *ids)
 
 	def onObjectsMoved(self, offset, *ids):
-		self.dispatch(evt="moveObjects", args=[offset] + list(ids))
+		self.dispatch(Opcode.MOVE_OBJECTS, offset, *ids)
 	
 	def onObjectUpdated(self, objectId, operation, args):
-		self.dispatch(evt="updateObject", args=(objectId, operation, args))
+		self.dispatch(protocol.UPDATE_OPCODES[operation], objectId, *args)
+
+	def getStrokeFlushInterval(self):
+		# points are sent once per frame on fast links; on slower links, they are batched for up to half a round trip
+		frameInterval = 1.0 / self.viewer.animationFrameRate
+		if self.rtt is None:
+			return frameInterval
+		return max(frameInterval, min(self.maxStrokeFlushInterval, self.rtt / 2))
+
+	def updateRtt(self, sample):
+		self.rtt = sample if self.rtt is None else 0.8 * self.rtt + 0.2 * sample
 
 	def onCursorMoved(self, pos):
 		now = t.time()
 		if now - self.lastCursorMoveTime > self.remoteUserCursorUpdateInterval:
 			#for i in range(1000):
-			self.dispatch(evt="moveUserCursor", args=(self.userName, pos,))
+			self.dispatch(Opcode.MOVE_USER_CURSOR, pos)
 			self.lastCursorMoveTime = now
 
+	def handleAddUser(self, sender, userName):
+		self.senderId2UserName[sender] = userName
+		self.addUser(userName)
+
 	def moveUserCursor(self, userName, pos):
 		sprite = self.viewer.userCursors.get(userName)
 		if sprite is None: return
-		sprite.animateMovement(pos, self.remoteUserCursorUpdateInterval)
+		self.viewer.animateMovement(sprite, pos, self.remoteUserCursorUpdateInterval)
 		#sprite.pos = pos
 
 	def _deserialize(self, s):
@@ -64,29 +117,126 @@ class DispatchingWhiteboard(Whiteboard):
 		objects = map(lambda o: self._deserialize(o), objects)
 		super(DispatchingWhiteboard, self).setObjects(objects)
 		if dispatch:
-			self.dispatchSetObjects(self.dispatcher)
+			self.dispatchPacket(Opcode.SET_OBJECTS, self.senderId, self.encodeSnapshot())
 	
-	def dispatchSetObjects(self, dispatcher):
-		dispatcher.dispatch(dict(evt="setObjects", args=([o.serialize() for o in self.getObjects()], False)))
+	def encodeSnapshot(self):
+		''' returns a SET_OBJECTS packet containing all objects '''
+		serializedObjects = [o.serialize() for o in self.getObjects()]
+		if self.viewer.lazyLoader is not None: # include the objects of the document that are not currently in memory
+			serializedObjects.extend(self.viewer.lazyLoader.serializedUnloadedObjects())
+		return self.encode(Opcode.SET_OBJECTS, serializedObjects)
 	
 	def updateObject(self, objectId, operation, args):
-		obj = self.viewer.objectsById.get(objectId)
+		obj = self.viewer.getObject(objectId)
 		if obj is None: return
-		eval("obj.%s(*args)" % operation)
+		getattr(obj, operation)(*args)
+
+	def encode(self, opcode, *args):
+		return protocol.encode(opcode, self.senderId, *args)
+
+	def dispatch(self, opcode, *args):
+		self.dispatchPacket(opcode, self.senderId, self.encode(opcode, *args))
+
+	def dispatchPacket(self, opcode, sender, packet, exclude=None):
+		''' sends an encoded packet to the other participants; the server sequences and logs operations before sending them '''
+		if self.isServer and opcode in protocol.SEQUENCED_OPCODES:
+			with self.sequenceLock:
+				seq = self.opLog.lastSeq + 1
+				packet = protocol.sequence(packet, seq)
+				self.opLog.append(seq, packet)
+				self.dispatcher.dispatchPacket(packet, exclude=exclude)
+		else:
+			if not self.isServer and opcode in protocol.SEQUENCED_OPCODES:
+				if self.connected:
+					self.opsSent += 1
+				else:
+					self.lastSeq = None # the server will not receive this operation, so the board must be resent when reconnecting
+			self.dispatcher.dispatchPacket(packet, exclude=exclude, coalesceKey=self.coalesceKey(opcode, sender))
+
+	def coalesceKey(self, opcode, sender):
+		''' returns the key under which packets are coalesced (latest wins) in the low-priority lane, or None for regular packets '''
+		if opcode == Opcode.MOVE_USER_CURSOR:
+			return sender
+		if opcode == Opcode.ACK:
+			return (opcode, sender)
+		return None
+
+	def acknowledgeOperation(self, conn):
+		''' server: acknowledges the receipt of an operation to the client that sent it (only the latest count is sent) '''
+		count = self.opsReceived.get(id(conn), 0) + 1
+		self.opsReceived[id(conn)] = count
+		conn.dispatchPacket(self.encode(Opcode.ACK, count), coalesceKey=self.coalesceKey(Opcode.ACK, self.senderId))
+
+	def onBlobMissing(self, key):
+		''' requests a blob referenced by a received object (a client asks the server, the server asks all clients) '''
+		self.dispatch(Opcode.BLOB_WANT, key)
 
-	def dispatch(self, exclude=None, **d):
-		self.dispatcher.dispatch(d, exclude=exclude)
+	def requestMissingBlobs(self, dispatcher):
+		''' requests the blobs that are still missing from the given connection (or all connections), since earlier requests
+			may have been lost or addressed to participants that did not have the blobs '''
+		keys = objects.imageBlobs.missingKeys()
+		if len(keys) > 0:
+			dispatcher.dispatchPacket(self.encode(Opcode.BLOB_WANT, *keys))
 
-	def handleNetworkEvent(self, d):
-		exec("self.%s(*d['args'])" % d["evt"])
+	def handleBlobTransfer(self, opcode, conn, args):
+		''' handles the point-to-point transfer of blobs: requested blobs are sent only to the participant asking for them;
+			the server, which holds every blob of the session, first requests blobs it does not have itself '''
+		blobs = objects.imageBlobs
+		if opcode == Opcode.BLOB_WANT:
+			dispatcher = conn if conn is not None else self.dispatcher
+			for key in args:
+				if self.isServer or key in blobs:
+					blobs.request(key, lambda key: self.sendBlob(dispatcher, key))
+		elif opcode == Opcode.BLOB_PUT:
+			key, data = args
+			if blobs.put(data) != key:
+				log.warning("received blob does not match its key %s", key)
+
+	def sendBlob(self, dispatcher, key):
+		data = objects.imageBlobs.get(key)
+		if data is not None:
+			dispatcher.dispatchPacket(self.encode(Opcode.BLOB_PUT, key, data), lane=Lane.BULK) # must not hold up edits
+
+	def handleJoin(self, conn, sessionId, lastSeq):
+		''' lets a client join the session: a client reconnecting to this session is sent the operations it missed,
+			provided that they are still in the log; otherwise the client is sent the entire board '''
+		with self.sequenceLock: # no operations must be sent in the meantime
+			conn.dispatchPacket(self.encode(Opcode.SESSION, self.sessionId))
+			missed = self.opLog.since(lastSeq) if sessionId == self.sessionId else None
+			if missed is None:
+				seq, snapshot, missed = self.joinSnapshot()
+				log.info("sending the board to %s (snapshot %d followed by %d operations)", conn, seq, len(missed))
+				conn.dispatchPacket(snapshot)
+			else:
+				log.info("resuming %s with %d operations", conn, len(missed))
+			for packet in missed:
+				conn.dispatchPacket(packet)
+
+	def joinSnapshot(self):
+		''' returns a tuple (seq, packet, ops) with a snapshot of the board sent to a joining client, which was taken
+			after operation seq and is followed by the operations ops; the most recent snapshot is reused (rather than
+			serializing the board for every client), unless the operations since then outweigh it.
+			Must be called with sequenceLock held '''
+		if self.snapshot is not None:
+			seq, packet = self.snapshot
+			ops = self.opLog.since(seq)
+			if ops is not None and sum(map(len, ops)) <= len(packet) * self.maxSnapshotCatchUpRatio:
+				return seq, packet, ops
+		seq = self.opLog.lastSeq
+		packet = protocol.sequence(self.encodeSnapshot(), seq)
+		self.snapshot = (seq, packet)
+		return seq, packet, []
+
+	def handleNetworkEvent(self, opcode, sender, args):
+		handler = self.networkHandlers.get(opcode)
+		if handler is not None:
+			handler(sender, *args)
 
 	def OnTimer(self, evt):
-		Player.OnTimer(self, evt)
-		# perform periodic ping from client to server
-		if not self.isServer:
-			if t.time() - self.lastPing > 1:
-				self.lastPing = t.time()
-				self.dispatch(ping = True)
+		# perform periodic ping in order to measure the round trip time
+		if t.time() - self.lastPing > 1:
+			self.lastPing = t.time()
+			self.dispatch(Opcode.PING, self.lastPing)
 
 	# server delegate methods
 	
@@ -94,11 +244,13 @@ class DispatchingWhiteboard(Whiteboard):
 		self.Show()
 	
 	def handle_ClientConnected(self, conn):
- 		conn.dispatch(dict(evt="addUser", args=(self.userName,)))
- 		self.dispatchSetObjects(conn)
+ 		conn.dispatchPacket(self.encode(Opcode.ADD_USER, self.userName))
+ 		self.requestMissingBlobs(conn)
+ 		# the board is sent once the client has joined (see handleJoin)
 
 	def handle_ClientConnectionLost(self, conn):
 		log.info("client connection lost: %s", conn)
+		self.opsReceived.pop(id(conn), None)
 		userName = self.connId2UserName.get(id(conn))
 		if userName is not None:
 			log.info("connection of user '%s' closed", userName)
@@ -113,9 +265,21 @@ class DispatchingWhiteboard(Whiteboard):
 	
 	def handle_ConnectedToServer(self):
 		self.Show()
-		self.dispatch(evt="addUser", args=(self.userName,))
+		self.connected = True
+		self.opsSent = self.opsAcknowledged = 0
+		if self.lastSeq is None:
+			self.resuming = False
+			self.dispatch(Opcode.JOIN, 0, 0)
+		else:
+			self.resuming = True
+			self.dispatch(Opcode.JOIN, self.sessionId, self.lastSeq)
+		self.dispatch(Opcode.ADD_USER, self.userName)
 
 	def handle_ConnectionToServerLost(self):
+		self.connected = self.joined = False
+		if self.opsAcknowledged < self.opsSent:
+			log.info("%d operations may not have reached the server", self.opsSent - self.opsAcknowledged)
+			self.lastSeq = None # resuming would lose them, so the board must be resent when reconnecting
 		self.deleteAllUsers()		
 		if self.questionDialog("No connection. Reconnect?\nClick 'No' to quit.", "Reconnect?"):
 			self.dispatcher.reconnect()
@@ -125,18 +289,49 @@ class DispatchingWhiteboard(Whiteboard):
 	# client/server delegate methods
 	
 	def handle_PacketReceived(self, data, conn):
-		d = pickle.loads(data)
-		if type(d) == dict and "ping" in d: # ignore pings
+		try:
+			opcode, sender, seq, args = protocol.decode(data)
+		except protocol.ProtocolError, e:
+			log.warning("ignoring invalid packet: %s", e)
+			return
+		if opcode == Opcode.PING: # answer pings directly (they are not forwarded)
+			(conn if conn is not None else self.dispatcher).dispatchPacket(self.encode(Opcode.PONG, *args))
+			return
+		if opcode == Opcode.PONG:
+			self.updateRtt(t.time() - args[0])
+			return
+		if opcode in (Opcode.BLOB_WANT, Opcode.BLOB_PUT): # not forwarded either
+			self.handleBlobTransfer(opcode, conn, args)
+			return
+		if opcode == Opcode.JOIN:
+			self.handleJoin(conn, *args)
+			return
+		if opcode == Opcode.SESSION:
+			self.sessionId = args[0]
+			self.joined = True
+			self.requestMissingBlobs(self.dispatcher)
+			return
+		if opcode == Opcode.ACK:
+			self.opsAcknowledged = args[0]
 			return
-		if type(d) == dict and "evt" in d:
-			if d["evt"] == "addUser":
-				log.info("addUser from %s with name '%s'", conn, d["args"][0])
-				self.connId2UserName[id(conn)] = d["args"][0]
-			# forward event to other clients
-			if self.isServer:
-				self.dispatch(exclude=conn, **d)
-			# handle in own player
-			self.handleNetworkEvent(d)
+		if self.isServer and opcode in protocol.SEQUENCED_OPCODES:
+			self.acknowledgeOperation(conn)
+		if not self.isServer and opcode in protocol.SEQUENCED_OPCODES:
+			if not self.joined: # sent before we joined, so the board or operations we are about to receive include it
+				return
+			self.lastSeq = seq
+			if opcode == Opcode.SET_OBJECTS:
+				self.resuming = False
+			elif sender == self.senderId and self.resuming: # own operation, which is resent when resuming, has already been applied
+				return
+		if opcode == Opcode.ADD_USER:
+			log.info("addUser from %s with name '%s'", conn, args[0])
+			self.connId2UserName[id(conn)] = args[0]
+		# forward the packet as is to other clients
+		if self.isServer:
+			self.dispatchPacket(opcode, sender, data, exclude=conn)
+		# handle in own player
+		self.handleNetworkEvent(opcode, sender, args)
 	
 	def setDispatcher(self, dispatcher):
 		self.dispatcher = dispatcher
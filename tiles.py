@@ -0,0 +1,113 @@
+# (C) 2014 by Dominik Jain (djain@gmx.net)
+
+import collections
+import math
+import pygame
+
+class TileCache(object):
+    ''' caches rendered content of the canvas as fixed-size tiles in absolute coordinates;
+        a tile is rendered on demand by drawContent(surface, rect, scale), which must draw the content of the absolute
+        rectangle rect onto the surface, scaled by the given factor, and is kept until it is invalidated or evicted
+        (least recently used first). At scale s, a tile of tileSize pixels thus covers tileSize/s absolute units '''
+
+    def __init__(self, drawContent, tileSize=256, maxTiles=256):
+        self.drawContent = drawContent
+        self.tileSize = tileSize
+        self.maxTiles = maxTiles
+        self.scale = 1.0
+        self.tiles = collections.OrderedDict() # (tx, ty) -> surface
+
+    def setScale(self, scale):
+        ''' sets the scale at which tiles are rendered, discarding all tiles if it changes '''
+        if scale != self.scale:
+            self.scale = scale
+            self.tiles.clear()
+
+    def tileRange(self, rect):
+        ''' returns the range (tx1, ty1, tx2, ty2) of the tiles that intersect the given absolute rectangle '''
+        ws = self.tileSize / self.scale
+        return (int(math.floor(rect.left / ws)), int(math.floor(rect.top / ws)), int(math.ceil(rect.right / ws)) - 1, int(math.ceil(rect.bottom / ws)) - 1)
+
+    def tileRect(self, tx, ty):
+        ws = self.tileSize / self.scale
+        return pygame.Rect(tx * ws, ty * ws, ws, ws)
+
+    def tile(self, tx, ty):
+        ''' returns the surface of the given tile, rendering it if it is not cached '''
+        key = (tx, ty)
+        surface = self.tiles.pop(key, None)
+        if surface is None:
+            surface = pygame.Surface((self.tileSize, self.tileSize)).convert()
+            self.drawContent(surface, self.tileRect(tx, ty), self.scale)
+            while len(self.tiles) >= self.maxTiles:
+                self.tiles.popitem(last=False)
+        self.tiles[key] = surface # most recently used
+        return surface
+
+    def invalidate(self, rect):
+        ''' discards all tiles intersecting the given absolute rectangle '''
+        if len(self.tiles) == 0:
+            return
+        tx1, ty1, tx2, ty2 = self.tileRange(rect)
+        if (tx2 - tx1 + 1) * (ty2 - ty1 + 1) > len(self.tiles):
+            for key in [k for k in self.tiles if tx1 <= k[0] <= tx2 and ty1 <= k[1] <= ty2]:
+                del self.tiles[key]
+        else:
+            for tx in xrange(tx1, tx2+1):
+                for ty in xrange(ty1, ty2+1):
+                    self.tiles.pop((tx, ty), None)
+
+    def clear(self):
+        self.tiles.clear()
+
+    def blit(self, screen, rect, offset):
+        ''' draws the tiles intersecting the absolute rectangle rect onto the screen, where offset is the absolute position
+            of the screen's top-left corner (clipping to rect is up to the caller) '''
+        tx1, ty1, tx2, ty2 = self.tileRange(rect)
+        ts = self.tileSize
+        x0 = int(math.floor(offset[0] * self.scale))
+        y0 = int(math.floor(offset[1] * self.scale))
+        for tx in xrange(tx1, tx2+1):
+            for ty in xrange(ty1, ty2+1):
+                screen.blit(self.tile(tx, ty), (tx * ts - x0, ty * ts - y0))
+
+if __name__=='__main__':
+    # benchmark: composing a scrolling viewport of a dense region from tiles compared to blitting every object
+    import os
+    import random
+    import time
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.display.init()
+    screen = pygame.display.set_mode((800, 600))
+    random.seed(0)
+    extent = 4000
+    image = pygame.Surface((60, 40)).convert()
+    image.fill((0, 0, 0))
+    image.set_colorkey((0, 0, 0))
+    pygame.draw.line(image, (255, 0, 0), (0, 0), (59, 39), 3)
+    numFrames = 100
+    print "%8s %18s %18s" % ("objects", "sprites [ms/frame]", "tiles [ms/frame]")
+    for n in (1000, 10000, 50000):
+        rects = [pygame.Rect(random.randint(0, extent), random.randint(0, extent), 60, 40) for i in xrange(n)]
+        def drawContent(surface, rect, scale):
+            surface.fill((255, 255, 255))
+            for r in rects:
+                if r.colliderect(rect):
+                    surface.blit(image, (r.x - rect.x, r.y - rect.y))
+        cache = TileCache(drawContent)
+        offsets = [(1000 + 10 * i, 1000 + 5 * i) for i in xrange(numFrames)]
+        times = []
+        for compose in ("sprites", "tiles"):
+            t = time.time()
+            for offset in offsets:
+                viewport = pygame.Rect(offset, screen.get_size())
+                if compose == "sprites":
+                    screen.fill((255, 255, 255))
+                    for r in rects:
+                        if r.colliderect(viewport):
+                            screen.blit(image, (r.x - offset[0], r.y - offset[1]))
+                else:
+                    cache.blit(screen, viewport, offset)
+            times.append((time.time() - t) / numFrames * 1e3)
+        print "%8d %18.2f %18.2f" % ((n,) + tuple(times))
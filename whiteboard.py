@@ -3,6 +3,8 @@
 import wx
 import os
 import thread
+import threading
+import array
 import traceback
 import sys
 import numpy
@@ -11,6 +13,7 @@ import pickle
 import time
 import logging
 import platform
+import docfile
 
 # deferred pygame imports
 global pygame
@@ -49,12 +52,19 @@ class SDLPanel(wx.Panel):
 
     def __del__(self):
         self.viewer.running = False
+        self.viewer.wakeUp()
 
 
 class Camera(object):
+    ''' maps absolute (world) coordinates to screen coordinates: pos is the absolute position of the screen's top-left corner
+        and zoom the number of screen pixels per absolute unit '''
+
+    zoomLevels = [2.0**i for i in range(-5, 3)] # zoom factors are quantized, such that renderings can be cached per level
+
     def __init__(self, pos, game):
         self.translate = numpy.array([-game.width / 2, -game.height / 2])
-        self.pos = pos + self.translate
+        self.pos = numpy.array(pos, dtype=float) + self.translate
+        self.zoom = 1.0
 
     def update(self, game):
         return self.pos
@@ -62,12 +72,66 @@ class Camera(object):
     def offset(self, o):
         self.pos += o
 
+    def worldToScreen(self, p):
+        return (numpy.asarray(p) - self.pos) * self.zoom
+
+    def screenToWorld(self, p):
+        return numpy.asarray(p, dtype=float) / self.zoom + self.pos
+
+    def worldRectToScreen(self, rect):
+        ''' returns the smallest integer screen rectangle covering the given absolute rectangle '''
+        x1, y1 = numpy.floor(self.worldToScreen(rect.topleft))
+        x2, y2 = numpy.ceil(self.worldToScreen(rect.bottomright))
+        return pygame.Rect(x1, y1, x2 - x1, y2 - y1)
+
+    def screenRectToWorld(self, rect):
+        ''' returns the smallest integer absolute rectangle covering the given screen rectangle '''
+        x1, y1 = numpy.floor(self.screenToWorld(rect.topleft))
+        x2, y2 = numpy.ceil(self.screenToWorld(rect.bottomright))
+        return pygame.Rect(x1, y1, x2 - x1, y2 - y1)
+
+    def zoomBy(self, steps, screenPos):
+        ''' changes the zoom by the given number of levels, keeping the absolute position at the given screen position fixed '''
+        level = min(range(len(self.zoomLevels)), key=lambda i: abs(self.zoomLevels[i] - self.zoom))
+        level = max(0, min(len(self.zoomLevels) - 1, level + steps))
+        worldPos = self.screenToWorld(screenPos)
+        self.zoom = self.zoomLevels[level]
+        self.pos = worldPos - numpy.asarray(screenPos, dtype=float) / self.zoom
+
+
+class FrameStatistics(object):
+    ''' collects the durations of rendering passes and periodically logs their distribution along with the number of active threads '''
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.reset(time.time())
+
+    def reset(self, now):
+        self.startTime = now
+        self.frameTimes = []
+        self.maxThreads = threading.active_count()
+
+    def addFrame(self, duration):
+        self.frameTimes.append(duration)
+        self.maxThreads = max(self.maxThreads, threading.active_count())
+        now = time.time()
+        if now - self.startTime >= self.interval:
+            a = numpy.array(self.frameTimes) * 1000
+            log.debug("%d frames in %.1f s; frame time: mean %.2f ms, std %.2f ms, max %.2f ms; max. active threads: %d",
+                len(a), now - self.startTime, a.mean(), a.std(), a.max(), self.maxThreads)
+            self.reset(now)
+
 
 class Viewer(object):
     def __init__(self, size, app):
         self.screen = pygame.display.set_mode(size, pygame.RESIZABLE)
         self.width, self.height = size
         self.running = False
+        self.wakeUpEventType = pygame.USEREVENT
+        self.wakeUpPending = False
+        self.animationFrameRate = 60
+        self.animatedObjects = set()
+        self.animationLock = threading.Lock()
+        self.frameStatistics = FrameStatistics()
         self.renderer = renderer.WhiteboardRenderer(self)
         self.camera = Camera((0, 0), self)
         self.app = app
@@ -83,6 +147,7 @@ class Viewer(object):
         self.mouseCursors["text"] = objects.ImageFromResource(os.path.join("img", "IBeam.png"), self, layer=1000, ppAlpha=True)
         self.mouseCursors["delete"] = objects.ImageFromResource(os.path.join("img", "Delete.png"), self, layer=1000, ppAlpha=True)
         self.mouseCursors["hand"] = objects.ImageFromResource(os.path.join("img", "Hand.png"), self, layer=1000, ppAlpha=True, alignment=objects.Alignment.CENTRE)
+        self.lazyLoader = None # provides the objects of a large document on demand (see docfile.LazyLoader)
         self.mouseCursor = None
         self.mouseCursorName = None
         self.haveMouseFocus = False        
@@ -90,27 +155,76 @@ class Viewer(object):
 
     def update(self):
         self.camera.update(self)
+        self.updateAnimations()
+        lazyLoader = self.lazyLoader
+        if lazyLoader is not None and lazyLoader.update(self.renderer.viewport(), self.addObject, self.releaseObject):
+            self.wakeUp() # continue materializing objects in the next frame
         self.renderer.update(self)
 
+    def animateMovement(self, obj, pos, duration):
+        ''' moves the given object to the given position over the given duration; may be called from any thread '''
+        obj.animateMovement(pos, duration)
+        with self.animationLock:
+            self.animatedObjects.add(obj)
+        self.wakeUp()
+
+    def updateAnimations(self):
+        ''' advances all ongoing animations in a single pass '''
+        now = time.time()
+        with self.animationLock:
+            animatedObjects = list(self.animatedObjects)
+        finished = [o for o in animatedObjects if not o.updateMovement(now)]
+        if len(finished) > 0:
+            with self.animationLock:
+                for o in finished:
+                    if not o.isAnimating():
+                        self.animatedObjects.discard(o)
+
     def draw(self):
         self.renderer.draw()
 
+    def wakeUp(self):
+        ''' causes the main loop to process a frame even if there is no input; may be called from any thread '''
+        if not self.wakeUpPending:
+            self.wakeUpPending = True
+            pygame.event.post(pygame.event.Event(self.wakeUpEventType))
+
+    def isAnimating(self):
+        ''' returns whether frames must currently be rendered at a fixed rate rather than on demand '''
+        return self.isLeftMouseButtonDown or self.scroll or len(self.animatedObjects) > 0
+
+    def nextEvents(self, clock):
+        ''' returns the events to process in the next frame, blocking until there is at least one unless we are animating '''
+        if self.isAnimating():
+            clock.tick(self.animationFrameRate)
+            return pygame.event.get()
+        events = [pygame.event.wait()]
+        events.extend(pygame.event.get())
+        clock.tick()
+        return events
+
     def mainLoop(self):
         self.running = True
         try:
             clock = pygame.time.Clock()
             while self.running:
                 try:
-                    clock.tick(60)
-                    for event in pygame.event.get():
+                    for event in self.nextEvents(clock):
                         # log(event)
                         
-                        if event.type == pygame.MOUSEBUTTONDOWN:
+                        if event.type == self.wakeUpEventType:
+                            self.wakeUpPending = False
+
+                        elif event.type == pygame.MOUSEBUTTONDOWN:
                             x, y = event.pos    
                             if event.button == 3:
                                 self.onRightMouseButtonDown(x, y)
                             elif event.button == 1:
                                 self.onLeftMouseButtonDown(x, y)
+                            elif event.button == 4: # mouse wheel up
+                                self.zoom(1, x, y)
+                            elif event.button == 5: # mouse wheel down
+                                self.zoom(-1, x, y)
     
                         elif event.type == pygame.MOUSEBUTTONUP:
                             if event.button == 3:
@@ -138,8 +252,10 @@ class Viewer(object):
                                 else:
                                     self.mouseCursor.kill()
     
+                    frameStartTime = time.time()
                     self.update()
                     self.draw()
+                    self.frameStatistics.addFrame(time.time() - frameStartTime)
                 except:
                     log.warning("rendering pass failed")
                     e, v, tb = sys.exc_info()
@@ -168,6 +284,7 @@ class Viewer(object):
             self.renderer.add(self.mouseCursor) 
 
     def setObjects(self, objects):
+        self.lazyLoader = None
         for o in self.getObjects():
             o.kill()
         for o in objects:
@@ -188,11 +305,25 @@ class Viewer(object):
                 obj.kill()
                 del self.objectsById[id]
                 deletedIds.append(id)
+            elif self.lazyLoader is not None:
+                self.lazyLoader.forget(id)
         return deletedIds
 
+    def releaseObject(self, obj):
+        ''' removes an object that is still part of the document but is no longer needed in memory '''
+        obj.kill()
+        self.objectsById.pop(obj.id, None)
+
+    def getObject(self, id):
+        ''' returns the object with the given id (materializing it if it is part of a lazily loaded document) or None '''
+        obj = self.objectsById.get(id)
+        if obj is None and self.lazyLoader is not None:
+            obj = self.lazyLoader.materialize(id, self.addObject)
+        return obj
+
     def moveObjects(self, offset, *ids):
         for id in ids:
-            obj = self.objectsById.get(id)
+            obj = self.getObject(id)
             if obj is not None:
                 obj.offset(*offset)
 
@@ -215,16 +346,21 @@ class Viewer(object):
         sprite = self.userCursors.get(userName)
         if sprite is not None:
             sprite.pos = pos
+            self.wakeUp()
 
     def onRightMouseButtonDown(self, x, y):
         self.prevMouseCursorName = self.mouseCursorName
         self.setMouseCursor("hand")
         self.scroll = True
 
+    def zoom(self, steps, x, y):
+        self.camera.zoomBy(steps, (x, y))
+        self.mouseCursor.pos = self.camera.screenToWorld((x, y))
+
     def onLeftMouseButtonDown(self, x, y):
         self.isLeftMouseButtonDown = True
         if self.activeTool is not None:
-            pos = numpy.array([x, y]) + self.camera.pos
+            pos = self.camera.screenToWorld((x, y))
             createdObject = self.activeTool.startPos(pos[0], pos[1])
             if createdObject is not None:
                 self.addObject(createdObject)
@@ -235,16 +371,16 @@ class Viewer(object):
 
     def onLeftMouseButtonUp(self, x, y):
         self.isLeftMouseButtonDown = False
-        pos = numpy.array([x, y]) + self.camera.pos
+        pos = self.camera.screenToWorld((x, y))
         if self.activeTool is not None:
             self.activeTool.end(*pos)
 
     def onMouseMove(self, x, y, dx, dy):
-        pos = numpy.array([x, y]) + self.camera.pos
+        pos = self.camera.screenToWorld((x, y))
         self.mouseCursor.pos = pos
 
         if self.scroll:
-            self.camera.offset(numpy.array([-dx, -dy]))
+            self.camera.offset(numpy.array([-dx, -dy]) / self.camera.zoom)
 
         if self.isLeftMouseButtonDown and self.activeTool is not None:
             self.activeTool.addPos(*pos)
@@ -277,9 +413,6 @@ class Tool(object):
     def addPos(self, x, y):
         pass
 
-    def screenPoint(self, x, y):
-        return numpy.array([x, y]) - self.camera.pos
-
     def end(self, x, y):
         self.obj = None
 
@@ -289,8 +422,8 @@ class SelectTool(Tool):
         self.noRect = pygame.Rect(0, 0, 0, 0)
     
     def reset(self):
-        self.selectionChooserRect = objects.Rectangle({"colour":(0,0,0,50), "rect":self.noRect.copy()}, self.viewer, isUserObject=False)
-        self.selectedAreaRect = objects.Rectangle({"colour":(0,255,150,50), "rect":self.noRect.copy()}, self.viewer, isUserObject=False)
+        self.selectionChooserRect = objects.Rectangle({"colour":(0,0,0,50), "rect":self.noRect.copy()}, self.viewer, isUserObject=False, scaleWithZoom=True)
+        self.selectedAreaRect = objects.Rectangle({"colour":(0,255,150,50), "rect":self.noRect.copy()}, self.viewer, isUserObject=False, scaleWithZoom=True)
         self.selectedObjects = None
         self.selectMode = True
     
@@ -304,9 +437,9 @@ class SelectTool(Tool):
     def startPos(self, x, y):
         self.selectMode = not self.selectedAreaRect.absRect().contains(pygame.Rect(x, y, 1, 1))
         log.debug("selectMode: %s", self.selectMode)
-        self.pos1 = self.screenPoint(x, y)
+        self.pos1 = numpy.array([x, y])
         self.pos2 = self.pos1
-        self.offset = numpy.array([0, 0])
+        self.offset = numpy.zeros(2)
         if self.selectMode:
             self.selectedAreaRect.kill()
             self.selectedAreaRect.rect = self.noRect.copy()
@@ -315,7 +448,7 @@ class SelectTool(Tool):
             self.wb.addObject(self.selectionChooserRect)
 
     def addPos(self, x, y):
-        self.pos2= self.screenPoint(x, y)
+        self.pos2 = numpy.array([x, y])
         if self.selectMode:
             width = self.pos2[0] - self.pos1[0]
             height = self.pos2[1] - self.pos1[1]
@@ -333,7 +466,7 @@ class SelectTool(Tool):
         if self.selectMode:
             width = self.pos2[0] - self.pos1[0]
             height = self.pos2[1] - self.pos1[1]
-            objs = filter(lambda o: o.rect.colliderect(pygame.Rect(self.pos1[0], self.pos1[1], width, height)), self.viewer.renderer.userObjects.sprites())
+            objs = self.viewer.renderer.userObjectsIn(pygame.Rect(self.pos1[0], self.pos1[1], width, height))
             log.debug("selected: %s", str(objs))
             self.selectedObjects = objs            
             self.selectionChooserRect.kill()
@@ -355,9 +488,7 @@ class RectTool(Tool):
 
     def addPos(self, x, y):
         if self.obj is None: return
-        topLeft = numpy.array([self.obj.rect.left, self.obj.rect.top])
-        pos = numpy.array([x, y]) - self.camera.pos
-        dim = pos - topLeft
+        dim = numpy.array([x, y]) - self.obj.pos
         if dim[0] > 0 and dim[1] > 0:
             self.obj.setSize(dim[0], dim[1])
 
@@ -374,9 +505,7 @@ class EraserTool(Tool):
         self.erase(x, y)
 
     def erase(self, x, y):
-        x, y = self.screenPoint(x, y)
-        sprites = self.viewer.renderer.userObjects.sprites() # TODO
-        matches = filter(lambda o: o.rect.collidepoint((x, y)), sprites)
+        matches = self.viewer.renderer.userObjectsAt(x, y)
         #log.debug("eraser matches: %s", matches)
         if len(matches) > 0:
             ids = [o.id for o in matches]
@@ -391,10 +520,11 @@ class PenTool(Tool):
         self.lineWidth = 3
         self.syncWhileDrawing = True
         self.lastProcessTime = 0
+        self.maxPointsPerFlush = 64
         self.mouseCursor = "pen"
 
     def startPos(self, x, y):
-        self.pointBuffer = []
+        self.pointBuffer = array.array("i")
         margin = 2 * self.lineWidth
         d = dict(lineWidth=self.lineWidth, colour=self.wb.getColour())
         if not self.syncWhileDrawing:
@@ -407,14 +537,15 @@ class PenTool(Tool):
 
     def addPos(self, x, y):
         if self.obj is None: return
-        self.obj.addPoints([(x, y)])
+        points = objects.pointArray([(x, y)]) # rounded the same way for the local stroke and the peers
+        self.obj.addPoints(points)
         if self.syncWhileDrawing:
-            self.pointBuffer.append((x, y))
+            self.pointBuffer.extend(points)
             t = time.time()
-            if t - self.lastProcessTime >= 0.5:
+            if t - self.lastProcessTime >= self.wb.getStrokeFlushInterval() or len(self.pointBuffer) >= 2 * self.maxPointsPerFlush:
                 self.lastProcessTime = t
                 self.wb.onObjectUpdated(self.obj.id, "addPoints", (self.pointBuffer,))
-                self.pointBuffer = []
+                self.pointBuffer = array.array("i")
 
     def end(self, x, y):
         self.obj.endDrawing()
@@ -446,9 +577,7 @@ class TextTool(Tool):
         wx.CallAfter(self.enterText, x, y)
     
     def enterText(self, x, y):
-        sx, sy = self.screenPoint(x, y)
-        textSprites = filter(lambda o: isinstance(o, objects.Text), self.viewer.renderer.userObjects.sprites()) 
-        matches = filter(lambda o: o.rect.collidepoint((sx, sy)), textSprites)
+        matches = filter(lambda o: isinstance(o, objects.Text), self.viewer.renderer.userObjectsAt(x, y))
         isNewObject = False
         if len(matches) > 0:
             obj = matches[0]
@@ -557,6 +686,9 @@ class Whiteboard(wx.Frame):
             self.frame_menubar.Append(joinedMenu, "Menu")
 
         self.viewer = self.pnlSDL.viewer
+        self.document = None # the document file that was last opened or saved
+        self.loadThread = None # the thread streaming the document that was last opened (see loadDocument)
+        self.lazyLoadingThreshold = 16 * 1024 * 1024 # documents of at least this size are loaded lazily
 
         toolbar = wx.Panel(self)
         self.toolbar = toolbar
@@ -626,10 +758,25 @@ class Whiteboard(wx.Frame):
             path = os.path.join(dlg.GetDirectory(), dlg.GetFilename())
             dlg.Destroy()
 
-            f = file(path, "rb")
-            d = pickle.load(f)
-            f.close()
-            self.viewer.setObjects([objects.deserialize(o, self.viewer) for o in d["objects"]])
+            self.viewer.setObjects([])
+            self.document = docfile.DocumentFile(path, objects.imageBlobs)
+            # the objects of a legacy document are converted, so it is always loaded in full
+            lazy = os.path.getsize(path) >= self.lazyLoadingThreshold and self.document.open() and not self.document.legacyObjects
+            if lazy and self.document.hasExtents():
+                self.viewer.lazyLoader = docfile.LazyLoader(self.document, lambda s: objects.deserialize(s, self.viewer))
+                self.viewer.wakeUp()
+            else:
+                self.loadThread = threading.Thread(target=self.loadDocument, args=(self.document,), name="load %s" % path)
+                self.loadThread.start()
+
+    def loadDocument(self, document):
+        ''' streams the objects of the given document into the viewer, such that they appear as they are read '''
+        try:
+            for obj in document.load(lambda s: objects.deserialize(s, self.viewer, legacy=document.legacyObjects)):
+                self.viewer.addObject(obj)
+        except:
+            log.exception("failed to load %s", document.path)
+            wx.CallAfter(self.errorDialog, "Could not load %s" % document.path)
 
     def onSave(self, event):
         log.debug("selected 'save'")
@@ -638,9 +785,28 @@ class Whiteboard(wx.Frame):
             path = os.path.join(dlg.GetDirectory(), dlg.GetFilename())
             dlg.Destroy()
 
-            f = file(path, "wb")
-            pickle.dump({"objects": [o.serialize() for o in self.viewer.getObjects()]}, f)
-            f.close()
+            lazyLoader = self.viewer.lazyLoader
+            if lazyLoader is None and (self.document is None or self.document.path != path):
+                self.document = docfile.DocumentFile(path, objects.imageBlobs)
+            loadThread = self.loadThread
+            objs = self.viewer.getObjects() if loadThread is None or not loadThread.is_alive() else None
+            threading.Thread(target=self.saveDocument, args=(self.document, lazyLoader, objs, path, loadThread), name="save %s" % path).start()
+
+    def saveDocument(self, document, lazyLoader, objs, path, loadThread=None):
+        ''' saves the given objects; if objs is None, the document is still being loaded, and the objects are saved once
+            loading has finished (saving them earlier would delete the objects not yet loaded from the document) '''
+        try:
+            if objs is None:
+                loadThread.join()
+                objs = self.viewer.getObjects()
+            if lazyLoader is not None:
+                lazyLoader.save(objs, path)
+                self.viewer.wakeUp() # objects are not materialized while saving
+            else:
+                document.save(objs)
+        except:
+            log.exception("failed to save %s", path)
+            wx.CallAfter(self.errorDialog, "Could not save %s" % path)
 
     def onExport(self, event):
         log.debug("selected 'export'")
@@ -650,6 +816,8 @@ class Whiteboard(wx.Frame):
             dlg.Destroy()
 
             objs = self.getObjects()
+            if self.viewer.lazyLoader is not None: # include the objects that are not currently in memory
+                objs = objs + [objects.deserialize(s, self.viewer) for s in self.viewer.lazyLoader.serializedUnloadedObjects()]
             rect = objects.boundingRect(objs)
             translate = numpy.array(rect.topleft) * -1
             surface = pygame.Surface(rect.size)
@@ -682,7 +850,12 @@ class Whiteboard(wx.Frame):
         image = pygame.image.fromstring(data, (bmp.GetWidth(), bmp.GetHeight()), "RGB")
         obj = objects.Image({"image": image, "rect": image.get_rect()}, self.viewer, isUserObject=True)
         self.addObject(obj)
-        self.onObjectCreationCompleted(obj)
+        # the image is encoded in the background and shared once this is done
+        obj.encodeAsync(lambda obj: wx.CallAfter(self.onImageEncoded, obj))
+
+    def onImageEncoded(self, obj):
+        if obj.alive(): # not deleted in the meantime
+            self.onObjectCreationCompleted(obj)
 
     def addObject(self, object):
         self.viewer.addObject(object)
@@ -702,6 +875,10 @@ class Whiteboard(wx.Frame):
     def onObjectUpdated(self, objectId, operation, args):
         pass
 
+    def getStrokeFlushInterval(self):
+        ''' returns the interval in seconds at which the points of a stroke being drawn are passed on to onObjectUpdated '''
+        return 0.5
+
     def deleteObjects(self, *objectIds):
         deletedIds = self.viewer.deleteObjects(*objectIds)
         if len(deletedIds) > 0: